@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+"""Functions of the scripts for use from Python, for example by a workflow engine running many small jobs in one
+long-lived process instead of starting a script for each:
+
+    import api
+    windows, ratios = api.bedRatios('s_phase.bed', 'g1.bed')
+    mapping = api.readMapping('mapping.csv')
+    with open('in.fasta', 'rb') as inputh, open('out.fasta', 'wb') as outputh:
+        api.renameFastaStream(inputh, outputh, mapping)
+
+Each script is only imported when one of its names is first used, so importing this module is fast and NumPy and
+requests are only loaded by the jobs that need them. Errors are raised as exceptions rather than ending the process,
+and the scripts log through the logging module without configuring it.
+"""
+
+import importlib
+
+# Public names and the script each one comes from
+_EXPORTS = {
+    'mfaseq_bed_py3': ['bedRatios', 'ratioFile', 'batchRatios', 'readBed', 'BedWindows', 'MfaseqError', 'processRatios', 'rollingMean',
+                       'rollingMedian', 'zScores', 'callPeaks'],
+    'renameFastaDefline': ['readMapping', 'writeMappingIndex', 'renameFasta', 'renameFastaStream', 'batchRename'],
+    'getAllGenomeFasta': ['listGenomeFiles', 'downloadFiles', 'GenomeFastaError', 'IncompatibleArgsError'],
+    'rnaSeqDump': ['dumpProject', 'RnaSeqDumpError'],
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = sorted(_MODULES)
+
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
+    value = getattr(importlib.import_module(_MODULES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
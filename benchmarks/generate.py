@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""Generates synthetic input files for the benchmarks: pairs of coverage bed files for mfaseq_bed_py3.py, and fasta
+files with mapping files for renameFastaDefline.py. The same seed always gives the same files."""
+
+from argparse import ArgumentParser
+import os
+import random
+
+# Sizes of the generated files. small runs in seconds; large is about the size of a Plasmodium falciparum MFA-seq run
+# at 100 bp windows and a large transcriptome
+SCALES = {
+    'small': {'chromosomes': 14, 'chromLength': 1600000, 'window': 1000, 'records': 5000, 'recordLength': 2000},
+    'large': {'chromosomes': 14, 'chromLength': 1600000, 'window': 100, 'records': 100000, 'recordLength': 3000},
+}
+# Bytes of random sequence from which the sequences of all the records are taken
+SEQUENCE_POOL = 1 << 20
+
+
+def writeBedPair(fileE, fileG, chromosomes, chromLength, window, seed=0):
+    """Writes two bed files of read counts in the same windows. The first has about twice as many reads as the second
+    near the replication origins placed along each chromosome, as in an S phase against G1 comparison."""
+    rng = random.Random(seed)
+    with open(fileE, 'w') as bedE, open(fileG, 'w') as bedG:
+        for chrom in range(chromosomes):
+            name = 'chr{0}'.format(chrom + 1)
+            origins = sorted(rng.randrange(chromLength) for i in range(3))
+            linesE, linesG = [], []
+            for start in range(0, chromLength - window + 1, window):
+                distance = min(abs(start - origin) for origin in origins)
+                depth = 20 * window / 1000
+                countG = int(rng.gauss(depth, depth ** 0.5))
+                countE = int(rng.gauss(depth * (1 + max(0.0, 1 - distance / 200000)), depth ** 0.5))
+                linesE.append('{0}\t{1}\t{2}\t{3}\n'.format(name, start, start + window, max(countE, 0)))
+                linesG.append('{0}\t{1}\t{2}\t{3}\n'.format(name, start, start + window, max(countG, 0)))
+            bedE.write(''.join(linesE))
+            bedG.write(''.join(linesG))
+
+
+def writeFasta(fileName, records, recordLength, wrap=60, seed=0):
+    """Writes a fasta file of nucleotide records with lengths around recordLength, wrapped at wrap bases per line.
+    Returns the ids of the records."""
+    rng = random.Random(seed)
+    pool = ''.join(rng.choice('ACGT') for i in range(SEQUENCE_POOL))
+    ids = []
+    with open(fileName, 'w') as fasta:
+        for i in range(records):
+            recordId = 'PF3D7_{0:07d}.1'.format(i)
+            length = max(1, int(rng.expovariate(1 / recordLength)))
+            if length < SEQUENCE_POOL:
+                start = rng.randrange(SEQUENCE_POOL - length)
+                sequence = pool[start:start + length]
+            else:
+                sequence = (pool * (length // SEQUENCE_POOL + 1))[:length]
+            lines = [sequence[j:j + wrap] for j in range(0, length, wrap)]
+            fasta.write('>{0} | transcript={0} | gene_product=synthetic protein | length={1}\n{2}\n'.format(recordId, length, '\n'.join(lines)))
+            ids.append(recordId)
+    return ids
+
+
+def writeMapping(fileName, ids, fraction=1.0, seed=0):
+    """Writes a mapping of a fraction of the ids to new ids."""
+    rng = random.Random(seed)
+    with open(fileName, 'w') as mapping:
+        mapping.write(''.join('{0},renamed_{0}\n'.format(recordId) for recordId in ids if fraction >= 1 or rng.random() < fraction))
+
+
+def generate(outputDir, scale='small', seed=0):
+    """Writes the bed pair, fasta file and mapping files of a scale to outputDir, and returns their names."""
+    sizes = SCALES[scale]
+    os.makedirs(outputDir, exist_ok=True)
+    files = {name: os.path.join(outputDir, fileName) for name, fileName in
+             [('bedE', 'e.bed'), ('bedG', 'g.bed'), ('fasta', 'transcripts.fasta'), ('mapping', 'mapping.csv'), ('subsetMapping', 'subset.csv')]}
+    writeBedPair(files['bedE'], files['bedG'], sizes['chromosomes'], sizes['chromLength'], sizes['window'], seed)
+    ids = writeFasta(files['fasta'], sizes['records'], sizes['recordLength'], seed=seed)
+    writeMapping(files['mapping'], ids, seed=seed)
+    writeMapping(files['subsetMapping'], ids, 0.01, seed=seed)
+    return files
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Generate synthetic bed, fasta and mapping files for the benchmarks')
+    parser.add_argument('--outputDir', required=True, help='Directory for the generated files')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small', help='Size of the generated files')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random number generator')
+    args = parser.parse_args()
+    for name, fileName in sorted(generate(args.outputDir, args.scale, args.seed).items()):
+        print('{0}\t{1}'.format(name, fileName))
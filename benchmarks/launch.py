@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+"""Runs a script with its requests to https://HOST/PATH sent to the stand-in server at http://ADDRESS/HOST/PATH.
+
+usage: launch.py SERVER_URL SCRIPT [ARGS ...]
+"""
+
+import os
+import runpy
+import sys
+
+import requests
+
+
+def redirect(serverUrl):
+    request = requests.Session.request
+
+    def redirected(self, method, url, *args, **kwargs):
+        if url.startswith('https://'):
+            url = '{0}/{1}'.format(serverUrl.rstrip('/'), url[len('https://'):])
+        return request(self, method, url, *args, **kwargs)
+
+    requests.Session.request = redirected
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        raise SystemExit(__doc__)
+    redirect(sys.argv[1])
+    sys.argv = sys.argv[2:]
+    # As when the script is run directly, modules next to it can be imported
+    sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+    runpy.run_path(sys.argv[0], run_name='__main__')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""Runs the scripts on synthetic data and reports the wall time and peak memory of each run.
+
+The network scripts are run against the local stand-in server in server.py, so the results do not depend on the
+VEuPathDB sites. Each benchmark is run in a fresh process, and its peak resident set size is taken from the resource
+usage of that process.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+from server import StandInServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAUNCH = os.path.join(REPO, 'benchmarks', 'launch.py')
+
+
+def script(name):
+    return os.path.join(REPO, name)
+
+
+def benchmarks(files, workDir, serverUrl):
+    """Returns the name, command, working directory and output directory (emptied before each run) of each benchmark."""
+    python = sys.executable
+    mfaseq = [python, script('mfaseq_bed_py3.py'), '--file1', files['bedE'], '--file2', files['bedG']]
+    rename = [python, script('renameFastaDefline.py'), '--fastaFile', os.path.basename(files['fasta'])]
+    dataDir = os.path.dirname(files['fasta'])
+    downloads = os.path.join(workDir, 'downloads')
+    dumps = os.path.join(workDir, 'rnaseq')
+    return [
+        ('mfaseq-bed', mfaseq + ['--out', os.path.join(workDir, 'ratios.bed')], workDir, None),
+        ('mfaseq-stream', mfaseq + ['--stream', '--out', os.path.join(workDir, 'ratios.bed')], workDir, None),
+        ('mfaseq-npz', mfaseq + ['--format', 'npz', '--out', os.path.join(workDir, 'ratios.npz')], workDir, None),
+        ('rename', rename + ['--mappingFile', files['mapping']], dataDir, None),
+        ('rename-subset-indexed', rename + ['--mappingFile', files['subsetMapping'], '--useIndex'], dataDir, None),
+        ('download', [python, LAUNCH, serverUrl, script('getAllGenomeFasta.py'), 'PlasmoDB,ToxoDB', '--type', 'genomic'], downloads, downloads),
+        ('dump', [python, LAUNCH, serverUrl, script('rnaSeqDump.py'), '--project', 'PlasmoDB', '--outputDir', dumps], workDir, dumps),
+    ]
+
+
+def measure(command, cwd):
+    """Runs a command and returns its exit status, wall time in seconds and peak resident set size in MB."""
+    start = time.time()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = usage.ru_maxrss / (1 << 20) if sys.platform == 'darwin' else usage.ru_maxrss / (1 << 10)
+    return os.waitstatus_to_exitcode(status), elapsed, peak
+
+
+def runBenchmarks(workDir, scale='small', repeat=3, latency=0.0, bandwidth=0, only=None):
+    """Generates the data, starts the stand-in server and runs each benchmark repeat times, returning the results."""
+    files = generate.generate(os.path.join(workDir, 'data'), scale)
+    server = StandInServer(scale=scale, latency=latency, bandwidth=bandwidth)
+    server.start()
+    results = []
+    try:
+        for name, command, cwd, outputDir in benchmarks(files, workDir, server.url):
+            if only and name not in only:
+                continue
+            times, peaks, failures = [], [], 0
+            for i in range(repeat):
+                if outputDir:
+                    shutil.rmtree(outputDir, ignore_errors=True)
+                    os.makedirs(outputDir)
+                status, elapsed, peak = measure(command, cwd)
+                failures += status != 0
+                times.append(elapsed)
+                peaks.append(peak)
+            results.append({'name': name, 'runs': repeat, 'failures': failures, 'median': statistics.median(times),
+                            'min': min(times), 'max': max(times), 'peakRssMB': max(peaks)})
+            sys.stderr.write('{0:<24} {1:>8.3f} s {2:>8.1f} MB{3}\n'.format(name, results[-1]['median'], results[-1]['peakRssMB'],
+                                                                          '  ({0} failed)'.format(failures) if failures else ''))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the scripts on synthetic data and a local stand-in for the VEuPathDB web services')
+    parser.add_argument('--scale', choices=sorted(generate.SCALES), default='small', help='Size of the generated data')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each benchmark; the median time is reported')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each response of the stand-in server')
+    parser.add_argument('--bandwidth', type=float, default=0, help='Maximum bytes per second sent in each response of the stand-in server, or 0 for no limit')
+    parser.add_argument('--only', nargs='+', help='Names of the benchmarks to run')
+    parser.add_argument('--workDir', help='Directory for the generated data and outputs, kept after the run. Defaults to a temporary directory')
+    parser.add_argument('--json', help='Write the results to this file as JSON')
+    args = parser.parse_args()
+
+    workDir = args.workDir or tempfile.mkdtemp(prefix='benchmarks_')
+    try:
+        results = runBenchmarks(os.path.abspath(workDir), args.scale, args.repeat, args.latency, args.bandwidth, args.only)
+    finally:
+        if not args.workDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'scale': args.scale, 'latency': args.latency, 'bandwidth': args.bandwidth, 'python': sys.version.split()[0],
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=1)
+    if any(result['failures'] for result in results):
+        raise SystemExit(1)
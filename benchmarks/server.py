@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for the VEuPathDB web services used by getAllGenomeFasta.py and rnaSeqDump.py.
+
+Requests for https://HOST/PATH are served at http://ADDRESS/HOST/PATH (see launch.py). The server answers the organism
+reports/standard search with links to genome, protein and GFF files it also serves, and the GenesByTaxon search, the
+transcript record type catalog and attributesTabular reports of synthetic RNA-seq experiments. Every response can be
+delayed by a fixed latency, and its body sent no faster than a given bandwidth.
+"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+# Size of the data served for each project
+SCALES = {
+    'small': {'organisms': 3, 'genes': 2000, 'experiments': 8, 'samples': 4, 'genomeLength': 2000000},
+    'large': {'organisms': 8, 'genes': 6000, 'experiments': 40, 'samples': 8, 'genomeLength': 10000000},
+}
+SEND_CHUNK = 1 << 16
+
+
+class StandInData(object):
+    """Synthetic organisms, genome files and RNA-seq experiments of a project, generated from a seed."""
+
+    def __init__(self, host, scale='small', seed=0):
+        sizes = SCALES[scale]
+        self.host = host
+        self.sizes = sizes
+        self.seed = seed
+        prefix = host.split('.')[0][:5].capitalize()
+        self.organisms = ['{0} organism {1}'.format(prefix, i) for i in range(sizes['organisms'])]
+        self.experiments = {'{0} experiment {1}'.format(prefix, i): ['{0}_exp{1}_s{2}'.format(prefix.lower(), i, j) for j in range(sizes['samples'])]
+                            for i in range(sizes['experiments'])}
+        self.experimentOrganisms = {experiment: self.organisms[i % len(self.organisms)] for i, experiment in enumerate(self.experiments)}
+        self.files = {}
+        self.reports = {}
+        self.lock = threading.Lock()
+
+    def _organismFile(self, organism):
+        return organism.replace(' ', '_')
+
+    def organismReport(self):
+        records = []
+        for i, organism in enumerate(self.organisms):
+            base = 'https://{0}/common/downloads/Current_Release/{1}'.format(self.host, self._organismFile(organism))
+            records.append({'displayName': organism, 'attributes': {
+                'is_reference_strain': 'yes' if i % 2 == 0 else 'no',
+                'URLGenomeFasta': '{0}/fasta/data/{1}_Genome.fasta'.format(base, self._organismFile(organism)),
+                'URLproteinFasta': '{0}/fasta/data/{1}_AnnotatedProteins.fasta'.format(base, self._organismFile(organism)),
+                'URLgff': '{0}/gff/data/{1}.gff'.format(base, self._organismFile(organism))}})
+        return {'records': records}
+
+    def organismVocabulary(self):
+        vocabulary = {'data': {'term': 'root'}, 'children': [{'data': {'term': organism}, 'children': []} for organism in self.organisms]}
+        return {'searchData': {'parameters': [{'displayName': 'Organism', 'vocabulary': vocabulary}]}}
+
+    def transcriptCatalog(self):
+        attributes = [{'name': 'primary_key', 'displayName': 'Gene ID'}, {'name': 'organism', 'displayName': 'Organism'}]
+        for experiment, samples in self.experiments.items():
+            for sample in samples:
+                attributes.append({'name': sample, 'displayName': sample, 'help': 'Transcript levels of {0} [Data set: {1}]'.format(sample, experiment)})
+        return {'attributes': attributes}
+
+    def file(self, path):
+        """Returns the contents and ETag of a downloadable file, or None if there is no such file."""
+        with self.lock:
+            if path not in self.files:
+                match = re.search(r'/Current_Release/([^/]+)/(?:fasta|gff)/data/[^/]+?(_Genome\.fasta|_AnnotatedProteins\.fasta|_AnnotatedCDSs\.fasta|_AnnotatedTranscripts\.fasta|\.gff)$', path)
+                if not match or match.group(1).replace('_', ' ') not in self.organisms:
+                    return None
+                contents = self._fileContents(match.group(1), match.group(2))
+                self.files[path] = (contents, '"{0}"'.format(hashlib.sha1(contents).hexdigest()))
+            return self.files[path]
+
+    def _fileContents(self, organism, kind):
+        rng = random.Random('{0}{1}{2}'.format(self.seed, organism, kind))
+        alphabet = 'ACDEFGHIKLMNPQRSTVWY' if 'Proteins' in kind else 'ACGT'
+        pool = ''.join(rng.choice(alphabet) for i in range(1 << 16))
+        if kind == '.gff':
+            lines = ['##gff-version 3\n']
+            for i in range(self.sizes['genes']):
+                start = i * 1000 + 1
+                lines.append('{0}_chr{1}\tVEuPathDB\tgene\t{2}\t{3}\t.\t+\t.\tID={0}_{4:07d}\n'.format(organism, i * 14 // self.sizes['genes'] + 1, start, start + 800, i))
+            return ''.join(lines).encode()
+        if kind == '_Genome.fasta':
+            records = [('{0}_chr{1}'.format(organism, i + 1), self.sizes['genomeLength'] // 14) for i in range(14)]
+        else:
+            records = [('{0}_{1:07d}'.format(organism, i), rng.randint(300, 3000) // (3 if 'Proteins' in kind else 1)) for i in range(self.sizes['genes'])]
+        chunks = []
+        for name, length in records:
+            sequence = (pool * (length // len(pool) + 2))[rng.randrange(len(pool)):][:length]
+            chunks.append('>{0}\n{1}\n'.format(name, '\n'.join(sequence[j:j + 60] for j in range(0, length, 60))))
+        return ''.join(chunks).encode()
+
+    def _organismRows(self, experiment, organism, attributes):
+        """Rows of the report for the genes of one organism, which only have values in its own experiments."""
+        key = (experiment, organism, tuple(attributes))
+        with self.lock:
+            if key not in self.reports:
+                rng = random.Random('{0}{1}{2}'.format(self.seed, experiment, organism))
+                own = self.experimentOrganisms[experiment] == organism
+                rows = []
+                for i in range(self.sizes['genes']):
+                    values = [organism if attribute == 'organism' else '{0:.2f}'.format(rng.lognormvariate(3, 1.5)) if own and rng.random() > 0.02 else 'N/A' for attribute in attributes]
+                    rows.append('\t'.join(['{0}_{1:07d}'.format(self._organismFile(organism), i)] + values))
+                self.reports[key] = ('\n'.join(rows) + '\n').encode()
+            return self.reports[key]
+
+    def tabularReport(self, body):
+        """Returns the attributesTabular report for a request, or None if it is not for one of the experiments."""
+        attributes = body['reportConfig']['attributes'][1:]
+        organisms = json.loads(body['searchConfig']['parameters']['organism'])
+        samples = [attribute for attribute in attributes if attribute != 'organism']
+        experiment = next((experiment for experiment, names in self.experiments.items() if samples and set(samples) <= set(names)), None)
+        if experiment is None or not set(organisms) <= set(self.organisms):
+            return None
+        header = '\t'.join(['Gene ID'] + ['Organism' if attribute == 'organism' else attribute for attribute in attributes]) + '\n'
+        return header.encode() + b''.join(self._organismRows(experiment, organism, attributes) for organism in organisms)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _data(self):
+        host = urlparse(self.path).path.split('/')[1]
+        with self.server.lock:
+            if host not in self.server.projects:
+                self.server.projects[host] = StandInData(host, self.server.scale, self.server.seed)
+            return self.server.projects[host]
+
+    def _send(self, status, body=b'', contentType='application/json', headers=None):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        start = time.time()
+        for offset in range(0, len(body), SEND_CHUNK):
+            self.wfile.write(body[offset:offset + SEND_CHUNK])
+            if self.server.bandwidth:
+                delay = start + (offset + SEND_CHUNK) / self.server.bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['bytes'] += len(body)
+
+    def _sendJson(self, data):
+        self._send(200, json.dumps(data).encode())
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        data = self._data()
+        if path.endswith('/reports/standard') and '/record-types/organism/' in path:
+            return self._sendJson(data.organismReport())
+        if path.endswith('/record-types/transcript/searches/GenesByTaxon'):
+            return self._sendJson(data.organismVocabulary())
+        if path.endswith('/record-types/transcript'):
+            return self._sendJson(data.transcriptCatalog())
+        if '/common/downloads/' in path:
+            return self._sendFile(data.file(path))
+        if path.count('/') <= 2:
+            # The home pages, which the scripts request to check the connection
+            return self._send(200, b'ok', 'text/plain')
+        return self._send(404, b'Not found', 'text/plain')
+
+    do_HEAD = do_GET
+
+    def _sendFile(self, found):
+        if found is None:
+            return self._send(404, b'Not found', 'text/plain')
+        contents, etag = found
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, headers={'ETag': etag})
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            offset = int(match.group(1))
+            if offset >= len(contents):
+                return self._send(416, headers={'Content-Range': 'bytes */{0}'.format(len(contents))})
+            return self._send(206, contents[offset:], 'application/octet-stream',
+                              {'ETag': etag, 'Content-Range': 'bytes {0}-{1}/{2}'.format(offset, len(contents) - 1, len(contents))})
+        return self._send(200, contents, 'application/octet-stream', {'ETag': etag})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path.endswith('/searches/GenesByTaxon/reports/attributesTabular'):
+            try:
+                report = self._data().tabularReport(json.loads(body))
+            except (ValueError, KeyError):
+                report = None
+            if report is None:
+                return self._send(400, b'Bad request', 'text/plain')
+            return self._send(200, report, 'text/plain')
+        return self._send(404, b'Not found', 'text/plain')
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Serves the stand-in web services, with latency in seconds added to each response and bandwidth in bytes per
+    second (0 for no limit) for each response body."""
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), scale='small', latency=0.0, bandwidth=0, seed=0):
+        super().__init__(address, StandInHandler)
+        self.scale = scale
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.seed = seed
+        self.projects = {}
+        self.stats = {'requests': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def start(self):
+        """Serves requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve a local stand-in for the VEuPathDB web services')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small', help='Size of the data served for each project')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each response')
+    parser.add_argument('--bandwidth', type=float, default=0, help='Maximum bytes per second sent in each response, or 0 for no limit')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random number generator')
+    args = parser.parse_args()
+    server = StandInServer(('127.0.0.1', args.port), args.scale, args.latency, args.bandwidth, args.seed)
+    print('Serving on {0}'.format(server.url))
+    server.serve_forever()
@@ -2,17 +2,29 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import hashlib
+import json
+import os
 import requests
-from argparse import ArgumentParser
-import urllib
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import logging
+import threading
+import time
+import zlib
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-ch = logging.StreamHandler()
-ch.setFormatter(logging.Formatter('%(levelname)s - %(asctime)s - %(message)s'))
-logger.addHandler(ch)
+import instrumentation
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+# Manifest of downloaded files used by --sync, written in the current directory
+SYNC_MANIFEST = 'genomeFastaManifest.json'
+
+
+class GenomeFastaError(Exception):
+    """Raised when the files of a project cannot be listed"""
 
 
 class GenomeFastaURLs(object):
@@ -30,14 +42,11 @@ class GenomeFastaURLs(object):
         s = self.get_session()
         res = s.get(url, verify=True)
         self.orgs = collections.deque()
-        if(res.ok):
-            j = res.json()
-        else:
-            try:
-                res.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                logger.error("Cannot retrieve file from url: {0}. Please check the URL is correct. In case of an outage at EuPathDB, please try again later.\n\n{1}".format(url, e))
-                raise SystemExit()
+        try:
+            res.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            raise GenomeFastaError("Cannot retrieve file from url: {0}. Please check the URL is correct. In case of an outage at EuPathDB, please try again later.\n\n{1}".format(url, e))
+        j = res.json()
         
         for record in j['records']:
             reference = True if record['attributes']['is_reference_strain'] == 'yes' else False
@@ -54,31 +63,425 @@ class GenomeFastaURLs(object):
             s = requests.session()
             s.get(self.baseurl)
         except requests.exceptions.ConnectionError as e:
-            logging.error("Cannot connect to {0}. Please check the project name '{1}' is correct and try again.\n\n{2}".format(self.baseurl, self.args.project, e))
-            raise SystemExit()
+            raise GenomeFastaError("Cannot connect to {0}. Please check the project name '{1}' is correct and try again.\n\n{2}".format(self.baseurl, self.project, e))
         return s
 
     def getBaseURL(self):
         baseUrl = "https://{0}.org".format(self.project)
         return baseUrl
 
-    def retrieveGenomeFastaFiles(self):
+    def files(self):
+        """Returns the url and local file name of each file to download"""
+        files = []
         for url in self.orgs:
             if self.args.type == 'cds':
                 url = url.replace('Proteins', 'CDSs')
             elif self.args.type == 'transcript':
                 url = url.replace('Proteins', 'Transcripts')
             o = urlparse(url)
-            path = o.path.split('/')[-1]
+            files.append((url, o.path.split('/')[-1]))
+        return files
+
+    def retrieveGenomeFastaFiles(self, downloader):
+        for url, path in self.files():
             if 'gff' in path:
-                logging.info('Retrieving GFF file {0} from {1}'.format(path, url))
+                logger.info('Retrieving GFF file {0} from {1}'.format(path, url))
+            else:
+                logger.info("Retrieving {0} fasta file {1} from {2}".format(self.args.type, path, url))
+            downloader.download(url, path)
+
+
+class FastaIndexer(object):
+    """Builds a samtools compatible .fai index from the bytes of a fasta file as they are written"""
+
+    def __init__(self):
+        self.offset = 0
+        self.carry = b''
+        self.records = []
+        self.valid = True
+
+    def update(self, chunk):
+        data = self.carry + chunk
+        end = data.rfind(b'\n') + 1
+        self.carry = data[end:]
+        # Header lines are handled one at a time, and the sequence lines between them as a block
+        start = 0
+        while start < end:
+            if data.startswith(b'>', start):
+                lineEnd = data.index(b'\n', start) + 1
+                self._line(data[start:lineEnd - 1], lineEnd - start)
+            else:
+                lineEnd = data.find(b'\n>', start, end) + 1 or end
+                self._sequence(data[start:lineEnd])
+            start = lineEnd
+
+    def _sequence(self, block):
+        """Handles a block of complete sequence lines, checking all the lines with the width of the record at once"""
+        if not self.records:
+            self.offset += len(block)
+            return
+        record = self.records[-1]
+        # The first line of a sequence sets its line width
+        while block and not record[3]:
+            lineEnd = block.index(b'\n') + 1
+            self._line(block[:lineEnd - 1], lineEnd)
+            block = block[lineEnd:]
+        if not block:
+            return
+        last = block.rfind(b'\n', 0, len(block) - 1) + 1
+        if self._fullLines(block, record):
+            self._addLines(block, record)
+        elif self._fullLines(block[:last], record):
+            # The last line of a sequence is usually shorter
+            self._addLines(block[:last], record)
+            self._line(block[last:-1], len(block) - last)
+        else:
+            for line in block.split(b'\n')[:-1]:
+                self._line(line, len(line) + 1)
+
+    @staticmethod
+    def _fullLines(block, record):
+        """Whether every line of a block has the line bases and width of a record"""
+        count, remainder = divmod(len(block), record[4])
+        if remainder or block.count(b'\n') != count or block[record[4] - 1::record[4]] != b'\n' * count:
+            return False
+        # Carriage returns are not counted as bases
+        returns = record[4] - 1 - record[3]
+        if returns == 0:
+            return b'\r\n' not in block
+        return returns == 1 and block[record[4] - 2::record[4]] == b'\r' * count and b'\r\r\n' not in block
+
+    def _addLines(self, block, record):
+        if record[5] and block:
+            # Only the last line of a sequence can be shorter than the others
+            self.valid = False
+        record[1] += len(block) // record[4] * record[3]
+        self.offset += len(block)
+
+    def _line(self, line, width):
+        if line.startswith(b'>'):
+            # name, length, offset, line bases, line width and whether a short line has been seen
+            self.records.append([line[1:].split()[0].decode() if line[1:].split() else '', 0, self.offset + width, 0, 0, False])
+        elif self.records:
+            record = self.records[-1]
+            bases = len(line.rstrip(b'\r'))
+            if record[5] and bases:
+                # Only the last line of a sequence can be shorter than the others
+                self.valid = False
+            if not record[3]:
+                record[3], record[4] = bases, width
+            elif bases != record[3] or width != record[4]:
+                record[5] = True
+            record[1] += bases
+        self.offset += width
+
+    def write(self, path):
+        if self.carry:
+            self._line(self.carry, len(self.carry))
+        if not self.valid:
+            logger.warning("Cannot index {0} because its sequence lines are not all the same length".format(path))
+            return
+        with open(path + '.fai', 'w') as f:
+            for name, length, offset, lineBases, lineWidth, short in self.records:
+                f.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(name, length, offset, lineBases, lineWidth))
+
+
+class GffIndexer(object):
+    """Records the byte ranges of each run of lines with the same seqid in a GFF file as it is written.
+
+    The index is a tab delimited .seqids file of seqid, offset and length, with one row per run of lines.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.carry = b''
+        self.runs = []
+        self.inFasta = False
+
+    def update(self, chunk):
+        lines = (self.carry + chunk).split(b'\n')
+        self.carry = lines.pop()
+        for line in lines:
+            self._line(line, len(line) + 1)
+
+    def _line(self, line, width):
+        if line.startswith(b'##FASTA'):
+            self.inFasta = True
+        if not self.inFasta and line and not line.startswith(b'#'):
+            seqid = line.split(b'\t', 1)[0].decode()
+            if self.runs and self.runs[-1][0] == seqid and self.runs[-1][1] + self.runs[-1][2] == self.offset:
+                self.runs[-1][2] += width
             else:
-                logging.info("Retrieving {0} fasta file {1} from {2}".format(args.type, path, url))
+                self.runs.append([seqid, self.offset, width])
+        self.offset += width
+
+    def write(self, path):
+        if self.carry:
+            self._line(self.carry, len(self.carry))
+        with open(path + '.seqids', 'w') as f:
+            for seqid, offset, length in self.runs:
+                f.write('{0}\t{1}\t{2}\n'.format(seqid, offset, length))
+
+
+class GunzipStream(object):
+    """Decompresses a gzip file chunk by chunk, including files made of several gzip members"""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(wbits=47)
+
+    def decompress(self, chunk):
+        data = self.decompressor.decompress(chunk)
+        while self.decompressor.eof and self.decompressor.unused_data:
+            remainder = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(wbits=47)
+            data += self.decompressor.decompress(remainder)
+        return data
+
+    def finish(self):
+        """Raises GenomeFastaError if the file ended part way through a gzip member"""
+        if not self.decompressor.eof:
+            raise GenomeFastaError("The gzip file is truncated: it ends before the end of its last member")
+
+
+class Downloader(object):
+    """Downloads files in a pool of threads sharing one session.
+
+    Downloads are queued per host. Workers take files from the hosts in turn, and no more than hostWorkers files are
+    downloaded from one host at a time, so a project with many files does not hold up the others.
+
+    Each file is streamed to a .part file, which is resumed with a Range request if a previous attempt was interrupted,
+    and renamed when complete. The ETag and Last-Modified date of the response are kept in a .part.json file next to it
+    and sent as If-Range, so a file that changed on the server in the meantime is downloaded again from the start.
+    Failed downloads are retried, and reported by wait once every download has finished.
+
+    If a manifest file is given, the ETag, Last-Modified date, size and SHA-256 checksum of each downloaded file are
+    recorded in it, and files that are still present locally are only downloaded again if the server reports a change.
+
+    Files can be gzipped (compress) or .gz files gunzipped (decompress) as they are downloaded, and fasta and GFF
+    files indexed (index). Partial downloads are only resumed when the file is written as it is received. The SHA-256
+    checksum of each file can be written next to it in the format of sha256sum (checksum), with or without a manifest.
+    """
+
+    chunkSize = 1 << 20
+
+    def __init__(self, workers=4, retries=3, manifest=None, hostWorkers=4, compress=False, decompress=False, index=False, checksum=False):
+        self.retries = retries
+        self.compress = compress
+        self.decompress = decompress
+        self.index = index
+        self.checksum = checksum
+        self.hostWorkers = hostWorkers
+        self.manifestFile = manifest
+        self.manifest = self._loadManifest(manifest)
+        self.lock = threading.Lock()
+        self.session = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=hostWorkers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.queues = collections.OrderedDict()
+        self.active = collections.Counter()
+        self.failures = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def download(self, url, path):
+        with self.condition:
+            self.queues.setdefault(urlparse(url).netloc, collections.deque()).append((url, path))
+            self.condition.notify()
+
+    def wait(self):
+        """Waits for all queued downloads to finish and returns a list of (url, error) for those that failed.
+
+        No more files can be queued afterwards.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        return self.failures
+
+    def _next(self):
+        """Returns the next (url, path) to download, taking hosts in turn, or None once the downloader is closed and empty"""
+        with self.condition:
+            while True:
+                for host in list(self.queues):
+                    if self.queues[host] and self.active[host] < self.hostWorkers:
+                        # Move the host to the back so the next download comes from another host
+                        self.queues.move_to_end(host)
+                        self.active[host] += 1
+                        return host, self.queues[host].popleft()
+                if self.closed and not any(self.queues.values()):
+                    return None
+                self.condition.wait()
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            host, (url, path) = job
+            try:
+                self._retrieve(url, path)
+            except Exception as e:
+                logger.error("Cannot retrieve file from url: {0}. Please check the URL is correct. In case of an outage at VEuPathDB please try again later.\n\n{1}".format(url, e))
+                with self.condition:
+                    self.failures.append((url, e))
+            with self.condition:
+                self.active[host] -= 1
+                self.condition.notify_all()
+
+    def _retrieve(self, url, path):
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.stage('download'):
+                    self._fetch(url, path)
+                return
+            except requests.exceptions.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                if attempt == self.retries or (status is not None and status < 500 and status != 429):
+                    raise
+                logger.warning("Retrying {0} after error: {1}".format(url, e))
+                metrics.count('retries')
+                time.sleep(2 ** attempt)
+
+    def _fetch(self, url, path):
+        decompress = self.decompress and path.endswith('.gz')
+        compress = self.compress and not path.endswith('.gz')
+        if decompress:
+            path = path[:-3]
+        elif compress:
+            path = path + '.gz'
+        partPath = path + '.part'
+        validator = self._partValidator(url, partPath) if os.path.exists(partPath) and not (compress or decompress) else None
+        offset = os.path.getsize(partPath) if validator else 0
+        if offset:
+            headers = {'Range': 'bytes={0}-'.format(offset), 'If-Range': validator['etag'] or validator['lastModified']}
+        else:
+            headers = self._conditionalHeaders(url, path)
+        with self.session.get(url, headers=headers, stream=True, timeout=60) as res:
+            if res.status_code == 416 or (res.status_code == 206 and self._validator(url, res) != validator):
+                # The partial file cannot be resumed, or the server ignored If-Range and sent part of a changed file,
+                # so start again
+                self._removePart(partPath)
+                return self._fetch(url, path)
+            if res.status_code == 304:
+                logger.info("{0} is unchanged".format(path))
+                metrics.count('unchangedFiles')
+                return
+            res.raise_for_status()
+            checksum = hashlib.sha256()
+            indexers = self._indexers(path) if self.index and not compress else []
+            mode = 'ab' if res.status_code == 206 else 'wb'
+            if mode == 'wb' and not (compress or decompress):
+                self._writeValidator(url, res, partPath)
+            if offset and mode == 'ab':
+                logger.info("Resuming {0} from byte {1}".format(path, offset))
+                with open(partPath, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.chunkSize), b''):
+                        checksum.update(chunk)
+                        for indexer in indexers:
+                            indexer.update(chunk)
+            # wbits=31 writes a gzip header
+            compressor = zlib.compressobj(wbits=31) if compress else None
+            decompressor = GunzipStream() if decompress else None
+            with open(partPath, mode) as f:
+                for chunk in res.iter_content(chunk_size=self.chunkSize):
+                    metrics.count('bytesReceived', len(chunk))
+                    if decompressor:
+                        chunk = decompressor.decompress(chunk)
+                    for indexer in indexers:
+                        indexer.update(chunk)
+                    if compressor:
+                        chunk = compressor.compress(chunk)
+                    checksum.update(chunk)
+                    f.write(chunk)
+                if decompressor:
+                    decompressor.finish()
+                if compressor:
+                    chunk = compressor.flush()
+                    checksum.update(chunk)
+                    f.write(chunk)
+        os.replace(partPath, path)
+        self._removePart(partPath)
+        for indexer in indexers:
+            indexer.write(path)
+        if self.checksum:
+            with open(path + '.sha256', 'w') as f:
+                f.write('{0}  {1}\n'.format(checksum.hexdigest(), os.path.basename(path)))
+        logger.info("Retrieved {0}".format(path))
+        metrics.count('files')
+        self._record(url, {'path': path, 'etag': res.headers.get('ETag'), 'lastModified': res.headers.get('Last-Modified'),
+                           'size': os.path.getsize(path), 'sha256': checksum.hexdigest()})
+
+    @staticmethod
+    def _validator(url, res):
+        """The ETag and Last-Modified date of a response, if either can be used in an If-Range header"""
+        # Weak ETags cannot be used in If-Range
+        etag = res.headers.get('ETag')
+        etag = etag if etag and not etag.startswith('W/') else None
+        lastModified = res.headers.get('Last-Modified')
+        return {'url': url, 'etag': etag, 'lastModified': lastModified} if etag or lastModified else None
+
+    def _writeValidator(self, url, res, partPath):
+        validator = self._validator(url, res)
+        if validator:
+            with open(partPath + '.json', 'w') as f:
+                json.dump(validator, f)
+        elif os.path.exists(partPath + '.json'):
+            os.remove(partPath + '.json')
+
+    @staticmethod
+    def _partValidator(url, partPath):
+        """The validator saved with a partial download, or None if it cannot be resumed safely"""
+        try:
+            with open(partPath + '.json') as f:
+                validator = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return validator if validator.get('url') == url else None
+
+    @staticmethod
+    def _removePart(partPath):
+        for fileName in (partPath, partPath + '.json'):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def _indexers(self, path):
+        return [GffIndexer()] if 'gff' in os.path.basename(path) else [FastaIndexer()]
+
+    def _loadManifest(self, fileName):
+        if fileName and os.path.exists(fileName):
             try:
-                urllib.request.urlretrieve(url, path)
-            except urllib.error.URLError as e:
-                logging.error("Cannot retrieve file from url: {0}. Please check the URL is correct. In case of an outage at EuPathDB please try again later.\n\n{1}".format(url, e))
-                raise SystemExit()
+                with open(fileName) as f:
+                    return json.load(f)
+            except ValueError as e:
+                logger.warning("Cannot read manifest {0}; all files will be downloaded again\n\n{1}".format(fileName, e))
+        return {}
+
+    def _conditionalHeaders(self, url, path):
+        entry = self.manifest.get(url)
+        if not self.manifestFile or not entry or entry['path'] != path or not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+            return {}
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['lastModified']:
+            headers['If-Modified-Since'] = entry['lastModified']
+        return headers
+
+    def _record(self, url, entry):
+        if not self.manifestFile:
+            return
+        with self.lock:
+            self.manifest[url] = entry
+            with open(self.manifestFile + '.tmp', 'w') as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            os.replace(self.manifestFile + '.tmp', self.manifestFile)
 
 
 
@@ -91,15 +494,31 @@ class ArgParser(ArgumentParser):
         self.add_argument('--includeUnannotated', action='store_true', help='For genomic sequences only, include fasta from organisms with no annotations')
         self.add_argument('--downloadGFF', action='store_true', help='For annotated genomes only, also download a GFF file')
         self.add_argument('--referenceOnly', action='store_true', help='Restrict downloads to VEuPathDB reference genomes')
+        self.add_argument('--workers', type=int, default=4, help='Number of files to download at the same time')
+        self.add_argument('--hostWorkers', type=int, default=4, help='Maximum number of files to download at the same time from one VEuPathDB site')
+        self.add_argument('--retries', type=int, default=3, help='Number of times to retry a failed download')
+        self.add_argument('--gzip', action='store_true', help='Compress files with gzip as they are downloaded')
+        self.add_argument('--gunzip', action='store_true', help='Decompress gzipped files as they are downloaded')
+        self.add_argument('--index', action='store_true', help='Index files as they are downloaded: a samtools compatible .fai index for fasta files, and a .seqids file of the byte ranges of each sequence for GFF files. Cannot be used with --gzip')
+        self.add_argument('--checksum', action='store_true', help='Write the SHA-256 checksum of each file, computed as it is downloaded, to a FILE.sha256 file in the format of sha256sum')
+        self.add_argument('--sync', action='store_true', help='Only download files that have changed since the last run with --sync, using a manifest of downloaded files ({0})'.format(SYNC_MANIFEST))
+        instrumentation.addArguments(self)
 
 
     def _parse_args (self):
         self.args = super().parse_args()
+        if self.args.workers < 1 or self.args.hostWorkers < 1:
+            self.error('--workers and --hostWorkers must be at least 1')
         if (self.args.type == 'transcript' or self.args.type == 'protein' or self.args.type == 'cds') and self.args.includeUnannotated:
             raise IncompatibleArgsError()
         return self.args
 
 
+    def _check_compression(self):
+        if self.args.gzip and (self.args.gunzip or self.args.index):
+            raise IncompatibleArgsError()
+
+
     def _check_gff(self):
         if not self.args:
             print('Checking')
@@ -122,6 +541,12 @@ class ArgParser(ArgumentParser):
             logging.error('GFF files cannot be retrieved for unannotated genomes. Please remove the --includeUnannotated flag, or do not use --downloadGFF\n\n{0}'.format(e))
             raise SystemExit()
 
+        try:
+            self._check_compression()
+        except IncompatibleArgsError as e:
+            logging.error('Compressed files cannot be decompressed or indexed. Please do not use --gzip with --gunzip or --index\n\n{0}'.format(e))
+            raise SystemExit()
+
         return self.args
 
 
@@ -134,8 +559,55 @@ class IncompatibleArgsError(Exception):
         return self.data
 
 
-if __name__ == '__main__':
-    args = ArgParser().parse_args()
-    for project in args.project.split(','):
+def listGenomeFiles(project, type='genomic', downloadGFF=False, includeUnannotated=False, referenceOnly=False):
+    """Returns the url and local file name of each file of a project that the script would download.
+
+    Raises GenomeFastaError if the files cannot be listed.
+    """
+    if includeUnannotated and (type != 'genomic' or downloadGFF):
+        raise IncompatibleArgsError()
+    args = Namespace(type=type, downloadGFF=downloadGFF, includeUnannotated=includeUnannotated, referenceOnly=referenceOnly)
+    return GenomeFastaURLs(args, project).files()
+
+
+def downloadFiles(files, outputDir='.', workers=4, retries=3, hostWorkers=4, sync=False, compress=False, decompress=False, index=False, checksum=False):
+    """Downloads (url, file name) pairs into outputDir, returning a list of (url, error) for those that failed.
+
+    With sync, the manifest of downloaded files is kept in outputDir.
+    """
+    downloader = Downloader(workers, retries, os.path.join(outputDir, SYNC_MANIFEST) if sync else None, hostWorkers, compress, decompress, index, checksum)
+    for url, path in files:
+        downloader.download(url, os.path.join(outputDir, path))
+    return downloader.wait()
+
+
+def retrieveProject(args, project, downloader):
+    with metrics.stage('list'):
         genomeFastaURLs = GenomeFastaURLs(args, project)
-        genomeFastaURLs.retrieveGenomeFastaFiles()
+    genomeFastaURLs.retrieveGenomeFastaFiles(downloader)
+
+
+def main(args):
+    downloader = Downloader(args.workers, args.retries, SYNC_MANIFEST if args.sync else None, args.hostWorkers, args.gzip, args.gunzip, args.index,
+                            args.checksum)
+    projects = args.project.split(',')
+    # Projects are queried at the same time, and their files are downloaded as soon as they are listed
+    with ThreadPoolExecutor(max_workers=len(projects)) as executor:
+        futures = [executor.submit(retrieveProject, args, project, downloader) for project in projects]
+    failedProjects = [project for project, future in zip(projects, futures) if future.exception()]
+    for project, future in zip(projects, futures):
+        if future.exception():
+            logger.error("{0}: {1}".format(project, future.exception()))
+    with metrics.stage('wait'):
+        failures = downloader.wait()
+    if failedProjects:
+        logger.error("Files could not be listed for {0}".format(', '.join(failedProjects)))
+    if failures:
+        logger.error("{0} files could not be retrieved. Run the same command again to retry them; partially downloaded files will be resumed".format(len(failures)))
+    if failedProjects or failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(message)s')
+    instrumentation.run(main, ArgParser().parse_args())
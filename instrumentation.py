@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""Timings and counters shared by the scripts, written as a JSON summary with --metrics, and cProfile output with
+--profile.
+
+Code records into the module level metrics object, which does nothing until it is enabled:
+
+    with metrics.stage('parse'):
+        ...
+    metrics.count('rows', len(rows))
+"""
+
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+class Metrics(object):
+    """Collects the time spent in each stage of a run and counts of what was processed, from any number of threads."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self.reset()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'maxSeconds': 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['maxSeconds'] = max(stage['maxSeconds'], seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        scale = 1 << 20 if sys.platform == 'darwin' else 1 << 10
+        with self.lock:
+            return {'script': os.path.basename(sys.argv[0]), 'arguments': sys.argv[1:], 'elapsedSeconds': elapsed,
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'counters': dict(self.counters),
+                    'perSecond': {name: value / elapsed for name, value in self.counters.items()} if elapsed else {},
+                    'peakRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+                    'peakChildRssMB': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+    def write(self, fileName):
+        with open(fileName, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+
+metrics = Metrics()
+
+
+def addArguments(parser):
+    parser.add_argument('--metrics', help='Write the time spent in each stage, counts of what was processed and peak memory use to this file as JSON')
+    parser.add_argument('--profile', help='Profile the run with cProfile and write the statistics to this file, for use with pstats or snakeviz')
+
+
+def run(main, args):
+    """Calls main(args), with metrics enabled if args.metrics is set and under cProfile if args.profile is set.
+
+    The metrics and profile are written even if main fails or exits.
+    """
+    if args.metrics:
+        metrics.enable()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            return profiler.runcall(main, args)
+        return main(args)
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile)
+        if args.metrics:
+            metrics.write(args.metrics)
@@ -4,94 +4,735 @@
 import sys
 import os.path
 import argparse
+import json
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
+import instrumentation
+from instrumentation import metrics
+
+# Number of bytes of BED text parsed in one block, number of lines read per block in --stream mode
+# and number of windows formatted per write
+PARSE_CHUNK = 1 << 24
+STREAM_LINES = 100000
+WRITE_CHUNK = 100000
+
+# Formats written directly from the arrays to a named file rather than as text, and the extensions used for output file names
+BINARY_FORMATS = ['bigwig', 'npz']
+EXTENSIONS = {'bed': 'bed', 'wig': 'wig', 'bigwig': 'bw', 'npz': 'npz'}
+
+
+class MfaseqError(Exception):
+    """Raised when the ratios of a pair of bed files cannot be computed or written"""
+
 
 def get_args():
     parser = argparse.ArgumentParser(description='Generates a bed or wig file from two bed files with the ratio of coverage', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('--file1', required=True, help='the first bed file (the ratio is first/second)')
-    parser.add_argument('--file2', required=True, help='the second bed file (the ratio is first/second)')
+    parser.add_argument('--file1', required=False, help='the first bed file (the ratio is first/second)')
+    parser.add_argument('--file2', required=False, help='the second bed file (the ratio is first/second)')
     parser.add_argument('--noNormalise', action='store_false', help="do not normalise files for read depth")
     parser.add_argument('--out', required=False, help='output file name, defaults to STDOUT')
-    parser.add_argument('--format', default='bed', required=False, choices=['bed', 'wig'], help="output format [bed]")
-    return parser.parse_args()
+    parser.add_argument('--format', default='bed', required=False, choices=['bed', 'wig', 'bigwig', 'npz'], help="output format [bed]. bigwig (which requires pyBigWig) and npz are binary formats and need --out")
+    parser.add_argument('--stream', action='store_true', help="process the files in blocks with constant memory. Windows are written in the order of the input files, which should be sorted")
+    parser.add_argument('--sums', required=False, help="totals of file1 and file2 used for normalisation, as two comma separated numbers or a file containing them. In --stream mode this skips the first pass over the files")
+    parser.add_argument('--writeSums', required=False, help="write the totals of file1 and file2 to this file for use with --sums")
+    parser.add_argument('--manifest', required=False, help="tab separated file of pairs to process instead of --file1 and --file2, one pair per line: file1, file2 and optionally the output file name. Each bed file is read once however many pairs it appears in")
+    parser.add_argument('--byChromosome', action='store_true', help="read the two files and compute and format the output for each chromosome in parallel")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="number of processes used with --manifest or --byChromosome")
+    parser.add_argument('--cache', action='store_true', help="save the parsed windows of each bed file to a binary sidecar file (<file>.mfacache.npy) and memory-map it on later runs while the bed file is unchanged")
+    parser.add_argument('--cacheDir', required=False, help="directory for --cache sidecar files, defaults to the directory of each bed file")
+    parser.add_argument('--smooth', choices=['mean', 'median'], help="replace each ratio with the mean or median of the ratios in a window of --smoothWindows windows centred on it, within its chromosome")
+    parser.add_argument('--smoothWindows', type=int, default=5, help="number of windows averaged by --smooth, an odd number")
+    parser.add_argument('--zscore', action='store_true', help="write the (smoothed) ratios as z-scores, the number of standard deviations from the mean of all the windows")
+    parser.add_argument('--peaks', required=False, help="write the regions where the (smoothed) ratios are at least --peakThreshold standard deviations above the mean to this bed file, with the highest value in each region and the start of the window where it is reached")
+    parser.add_argument('--peakThreshold', type=float, default=2.0, help="number of standard deviations above the mean for a window to be part of a --peaks region")
+    parser.add_argument('--peakMinWindows', type=int, default=3, help="minimum number of consecutive windows in a --peaks region")
+    instrumentation.addArguments(parser)
+    args = parser.parse_args()
+    if args.cache and args.stream:
+        parser.error('--cache cannot be used with --stream')
+    if args.stream and (args.smooth or args.zscore or args.peaks):
+        parser.error('--smooth, --zscore and --peaks cannot be used with --stream')
+    if args.smoothWindows < 1 or args.smoothWindows % 2 == 0:
+        parser.error('--smoothWindows should be a positive odd number')
+    if args.peaks and args.manifest:
+        parser.error('--peaks cannot be used with --manifest')
+    if args.format in BINARY_FORMATS and (args.stream or not (args.out or args.manifest)):
+        parser.error('--format {0} needs --out and cannot be used with --stream'.format(args.format))
+    if args.byChromosome and (args.stream or args.manifest):
+        parser.error('--byChromosome cannot be used with --stream or --manifest')
+    if args.manifest:
+        if args.file1 or args.file2 or args.out or args.stream or args.sums or args.writeSums:
+            parser.error('--manifest cannot be used with --file1, --file2, --out, --stream, --sums or --writeSums')
+    elif not (args.file1 and args.file2):
+        parser.error('--file1 and --file2 are required unless --manifest is used')
+    return args
 
 def fileWriter (line, fileHandle):
     fileHandle.write(str(line) + "\n")
     return
 
+def blockWriter (lines, fileHandle):
+    if lines:
+        fileHandle.write("\n".join(lines) + "\n")
+    return
+
 def checkCount(windowCount, conversionFactor):
-    if windowCount < 1:
-        windowCount = 0.001
+    windowCount = np.where(windowCount < 1, 0.001, windowCount)
     return windowCount * conversionFactor
 
 
-def main():
-    args = get_args()
+class BedWindows(object):
+    """Windows of a four column bed file held as typed arrays.
 
-    fileE = args.file1
-    fileG = args.file2
+    chroms lists the chromosome names in order of first appearance and chromCodes indexes into it,
+    one entry per line of the file.
+    """
 
-    fileHandle = sys.stdout
+    def __init__(self, chroms, chromCodes, starts, ends, values):
+        self.chroms = chroms
+        self.chromCodes = chromCodes
+        self.starts = starts
+        self.ends = ends
+        self.values = values
 
-    if args.out:
-        fileHandle = open(args.out,"w")
+    def __len__(self):
+        return len(self.starts)
 
-    sumE = 0
-    sumG = 0
-    lineNo = 0
-    data = {}
+    def truncate(self, length):
+        return BedWindows(self.chroms, self.chromCodes[:length], self.starts[:length], self.ends[:length], self.values[:length])
+
+    def window(self, index):
+        return self.chroms[self.chromCodes[index]], self.starts[index], self.ends[index]
+
+    def take(self, indices):
+        return BedWindows(self.chroms, self.chromCodes[indices], self.starts[indices], self.ends[indices], self.values[indices])
+
+
+def _splitLines(lines, firstLineNo):
+    text = ''.join(lines)
+    if not text.endswith('\n'):
+        text += '\n'
+    fields = text.replace('\n', '\t').split('\t')
+    fields.pop()
+    if len(fields) == 4 * len(lines):
+        return fields
+    # Slow path for lines with trailing whitespace or the wrong number of columns
+    fields = []
+    for lineNo, line in enumerate(lines, firstLineNo):
+        columns = line.rstrip().split('\t')
+        if len(columns) != 4:
+            raise ValueError('line {0} does not have four tab separated columns'.format(lineNo))
+        fields.extend(columns)
+    return fields
+
+
+def parseLines(lines, lineNo, chromIndex, fileName):
+    try:
+        with metrics.stage('parse'):
+            fields = _splitLines(lines, lineNo)
+            chroms = fields[0::4]
+            for chrom in dict.fromkeys(chroms):
+                chromIndex.setdefault(chrom, len(chromIndex))
+            chromCodes = np.fromiter(map(chromIndex.__getitem__, chroms), dtype=np.int32, count=len(chroms))
+            starts = np.array(fields[1::4], dtype=np.int64)
+            ends = np.array(fields[2::4], dtype=np.int64)
+            values = np.array(fields[3::4], dtype=np.float64)
+            finite = np.isfinite(values)
+            if not finite.all():
+                raise ValueError('line {0} has a value that is not a finite number'.format(lineNo + int(np.argmin(finite))))
+            values = np.trunc(values).astype(np.int64)
+    except ValueError as e:
+        raise ValueError('{0}, lines {1}-{2}: {3}'.format(fileName, lineNo, lineNo + len(lines) - 1, e))
+    metrics.count('lines', len(lines))
+    return BedWindows(list(chromIndex), chromCodes, starts, ends, values)
+
+
+def readBed(fileName):
+    chromIndex = {}
+    blocks = []
+    lineNo = 1
+    with open(fileName) as f:
+        for lines in iter(lambda: f.readlines(PARSE_CHUNK), []):
+            blocks.append(parseLines(lines, lineNo, chromIndex, fileName))
+            lineNo += len(lines)
+    if not blocks:
+        empty = np.zeros(0, dtype=np.int64)
+        return BedWindows([], np.zeros(0, dtype=np.int32), empty, empty, empty)
+    return BedWindows(list(chromIndex), np.concatenate([block.chromCodes for block in blocks]), np.concatenate([block.starts for block in blocks]),
+                      np.concatenate([block.ends for block in blocks]), np.concatenate([block.values for block in blocks]))
+
+
+def _sidecarKey(fileName):
+    stat = os.stat(fileName)
+    return {'path': os.path.abspath(fileName), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def readBedWithSidecar(fileName, cacheDir=None):
+    """As readBed, using a binary sidecar of the parsed windows when it matches the path, size and modification time of the file.
+
+    The sidecar is a .npy file of the chromosome codes, starts, ends and values as the rows of one int64 array, which is
+    memory-mapped, and a .json file holding the key and the chromosome names.
+    """
+    sidecar = os.path.join(cacheDir or os.path.dirname(os.path.abspath(fileName)), os.path.basename(fileName) + '.mfacache')
+    key = _sidecarKey(fileName)
     try:
-        with open(fileE) as f1, open(fileG) as f2:
-            for lineE, lineG in zip(f1, f2):
-                lineNo += 1
-                chromE, startE, endE, valE = lineE.rstrip().split('\t')
-                chromG, startG, endG, valG = lineG.rstrip().split('\t')
-                if ((chromE != chromG) or (startE != startG) or (endE != endG)):
-                    raise SystemExit("There is a mismatch between file1 and file2\nFile1:{chrom1}\t{start1}\t{end1}\nFile2:{chrom2}\t{start2}\t{end2}\n".format(chrom1=chromE,start1=startE,end1=endE,chrom2=chromG,start2=startG,end2=endE))
-                sumE += int(float(valE))
-                sumG += int(float(valG))
-                if chromE in data.keys():
-                    data[chromE][int(startE)] = {"chrom":chromE, "start":startE, "end":endE, "valE":int(float(valE)), "valG":int(float(valG))}
-                else:
-                    data[chromE] = {}
-                    data[chromE][int(startE)] = {"chrom":chromE, "start":startE, "end":endE, "valE":int(float(valE)), "valG":int(float(valG))}
-        f1.close()
-        f2.close()
+        with open(sidecar + '.json') as f:
+            header = json.load(f)
+        if header['key'] == key:
+            columns = np.load(sidecar + '.npy', mmap_mode='r')
+            return BedWindows(header['chroms'], columns[0], columns[1], columns[2], columns[3])
+    except (IOError, ValueError, KeyError):
+        pass
+
+    windows = readBed(fileName)
+    try:
+        # The header is written last, so an interrupted write leaves no valid sidecar
+        with open(sidecar + '.npy.tmp', 'wb') as f:
+            np.save(f, np.vstack((windows.chromCodes, windows.starts, windows.ends, windows.values)).astype(np.int64))
+        os.replace(sidecar + '.npy.tmp', sidecar + '.npy')
+        with open(sidecar + '.json.tmp', 'w') as f:
+            json.dump({'key': key, 'chroms': windows.chroms}, f)
+        os.replace(sidecar + '.json.tmp', sidecar + '.json')
     except IOError as e:
-        raise SystemExit("ERROR: Cannot open file: '{0}: {1}'\n".format(e.strerror, e.filename))
-    except:
-        raise SystemExit ("ERROR: There is a mismatch between file1 and file2 at line {line}\nFile1:{chrom1}\t{start1}\t{end1}\nFile2:{chrom2}\t{start2}\t{end2}\n".format(line=lineNo,chrom1=chromE,start1=startE,end1=endE,chrom2=chromG,start2=startG,end2=endE))
+        sys.stderr.write("WARNING: Cannot write cache file: '{0}: {1}'\n".format(e.strerror, e.filename))
+    return windows
+
+
+def bedReader(args):
+    return partial(readBedWithSidecar, cacheDir=args.cacheDir) if args.cache else readBed
+
+
+def readBedPair(fileE, fileG, reader=readBed):
+    with metrics.stage('read'):
+        windowsE = reader(fileE)
+        windowsG = reader(fileG)
+    length = min(len(windowsE), len(windowsG))
+    windowsE = windowsE.truncate(length)
+    windowsG = windowsG.truncate(length)
+    checkWindows(windowsE, windowsG)
+    return windowsE, windowsG
+
+
+def readBedPairs(fileE, fileG, blockLines=STREAM_LINES):
+    """Yields the line number of the first line and the windows of both files for blocks of lines read in step.
 
+    As with zip, reading stops at the end of the shorter file.
+    """
+    chromIndexE = {}
+    chromIndexG = {}
+    lineNo = 1
+    with open(fileE) as f1, open(fileG) as f2:
+        while True:
+            linesE = list(islice(f1, blockLines))
+            linesG = list(islice(f2, len(linesE)))
+            linesE = linesE[:len(linesG)]
+            if not linesE:
+                break
+            yield lineNo, parseLines(linesE, lineNo, chromIndexE, fileE), parseLines(linesG, lineNo, chromIndexG, fileG)
+            lineNo += len(linesE)
+
+
+def checkWindows(windowsE, windowsG, lineNo=1):
+    # Map chromosome codes from the second file onto the first so the two can be compared directly
+    chromIndex = {chrom: code for code, chrom in enumerate(windowsE.chroms)}
+    translate = np.array([chromIndex.get(chrom, -1) for chrom in windowsG.chroms], dtype=np.int32)
+    mismatch = (windowsE.chromCodes != translate[windowsG.chromCodes]) if len(translate) else np.zeros(len(windowsE), dtype=bool)
+    mismatch |= (windowsE.starts != windowsG.starts) | (windowsE.ends != windowsG.ends)
+    if mismatch.any():
+        index = int(np.argmax(mismatch))
+        chromE, startE, endE = windowsE.window(index)
+        chromG, startG, endG = windowsG.window(index)
+        raise MfaseqError("There is a mismatch between file1 and file2 at line {line}\nFile1:{chrom1}\t{start1}\t{end1}\nFile2:{chrom2}\t{start2}\t{end2}".format(line=index+lineNo,chrom1=chromE,start1=startE,end1=endE,chrom2=chromG,start2=startG,end2=endG))
+
+
+def windowOrder(windows):
+    # Chromosomes in order of first appearance, windows sorted by start; a repeated window replaces the earlier one
+    order = np.lexsort((np.arange(len(windows)), windows.starts, windows.chromCodes))
+    codes = windows.chromCodes[order]
+    starts = windows.starts[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[:-1] = (codes[1:] != codes[:-1]) | (starts[1:] != starts[:-1])
+    return order[keep]
+
+
+def computeRatios(valuesE, valuesG, conversionFactor):
+    countsE = checkCount(valuesE, 1)
+    countsG = checkCount(valuesG, conversionFactor)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = countsE/countsG
+    return ratios
+
+
+def readSums(sums):
+    if os.path.isfile(sums):
+        with open(sums) as f:
+            sums = f.read()
+    try:
+        sumE, sumG = [int(float(total)) for total in sums.strip().split(',')]
+    except ValueError:
+        raise MfaseqError("--sums should be two comma separated numbers, or a file containing them: '{0}'".format(sums.strip()))
+    return sumE, sumG
+
+
+def writeSums(fileName, sumE, sumG):
+    with open(fileName, 'w') as f:
+        fileWriter('{0},{1}'.format(sumE, sumG), f)
+
+
+def conversionFactor(sumE, sumG, normalise):
     try:
-        gConversionFactor = 1 if not args.noNormalise else sumE/sumG
+        gConversionFactor = 1 if not normalise else sumE/sumG
     except ZeroDivisionError as detail:
-        raise SystemExit('ERROR: there is a problem calculating gConversion factor:%s\n' % detail)
-
-    for chromosome, chrData in data.items():
-        if args.format == 'wig':
-            firstEntry = chrData.keys()[0]
-            windowSize = int(chrData[firstEntry]['end']) - int(chrData[firstEntry]['start'])
-            print(windowSize)
-            headerLine = "fixedStep  chrom={0}  start=1  step={1}  span={2}".format(chromosome, windowSize, windowSize-1)
-            fileWriter(headerLine, fileHandle)
-        for window, windowData in sorted(chrData.items()):
-            countsE = checkCount(windowData['valE'],1)
-            countsG = checkCount(windowData['valG'],gConversionFactor)
-
-            try:
-                ratio = countsE/countsG
-            except ZeroDivisionError:
-                raise SystemExit('ERROR: Ratio for window {0}:{1}-{2} could not be computed. Attempted calculation was countsE/countsG.')
-
-            if args.format == 'wig':
-                line = '{:4.5f}'.format(ratio)
-                fileWriter(line, fileHandle)
-            elif args.format == 'bed':
-                line = '{chrom}\t{start}\t{end}\t{ratio:4.5f}'.format(chrom=windowData['chrom'], start=windowData['start'], end=windowData['end'], ratio=ratio)
-                fileWriter(line, fileHandle)
-
-
-    if args.out:
+        raise MfaseqError('there is a problem calculating gConversion factor:%s' % detail)
+    return gConversionFactor
+
+
+def checkRatios(windows, ratios):
+    if not np.isfinite(ratios).all():
+        chrom, start, end = windows.window(int(np.argmin(np.isfinite(ratios))))
+        raise MfaseqError('Ratio for window {0}:{1}-{2} could not be computed. Attempted calculation was countsE/countsG.'.format(chrom, start, end))
+
+
+def formatLines(chromosome, starts, ends, ratios, fileFormat):
+    if fileFormat == 'wig':
+        return list(map('{:4.5f}'.format, ratios.tolist()))
+    elif fileFormat == 'bed':
+        # The chromosome name is built into the template so each line is a single call to format
+        template = chromosome.replace('{', '{{').replace('}', '}}') + '\t{}\t{}\t{:4.5f}'
+        return list(map(template.format, starts.tolist(), ends.tolist(), ratios.tolist()))
+
+
+def wigHeader(chromosome, start, end):
+    windowSize = int(end) - int(start)
+    return "fixedStep  chrom={0}  start=1  step={1}  span={2}".format(chromosome, windowSize, windowSize-1)
+
+
+def chromosomeBounds(windows, order):
+    """Returns the limits of each chromosome in order, and the line on which each chromosome first appears"""
+    bounds = np.searchsorted(windows.chromCodes[order], np.arange(len(windows.chroms) + 1))
+    firstLines = np.unique(windows.chromCodes, return_index=True)[1]
+    return bounds, firstLines
+
+
+def chromosomeBlocks(windows, order, ratios, fileFormat, code, bounds, firstLines):
+    """Yields the output lines for one chromosome in blocks"""
+    chromosome = windows.chroms[code]
+    chrOrder = order[bounds[code]:bounds[code+1]]
+    if fileFormat == 'wig':
+        # The window size is taken from the first window of the chromosome as it appears in the file
+        firstStart = windows.starts[firstLines[code]]
+        firstEntry = chrOrder[np.searchsorted(windows.starts[chrOrder], firstStart)]
+        yield [wigHeader(chromosome, windows.starts[firstEntry], windows.ends[firstEntry])]
+    for block in range(0, len(chrOrder), WRITE_CHUNK):
+        blockOrder = chrOrder[block:block+WRITE_CHUNK]
+        yield formatLines(chromosome, windows.starts[blockOrder], windows.ends[blockOrder], ratios[blockOrder], fileFormat)
+
+
+def writeRatios(windows, order, ratios, fileFormat, fileHandle):
+    bounds, firstLines = chromosomeBounds(windows, order)
+    for code in range(len(windows.chroms)):
+        for lines in chromosomeBlocks(windows, order, ratios, fileFormat, code, bounds, firstLines):
+            blockWriter(lines, fileHandle)
+
+
+def writeBigWig(windows, order, ratios, fileName):
+    try:
+        import pyBigWig
+    except ImportError:
+        raise MfaseqError('bigwig output requires the pyBigWig library. Please install it (e.g., pip install pyBigWig) and try again.')
+    bounds, firstLines = chromosomeBounds(windows, order)
+    chromSizes = [(chromosome, int(windows.ends[order[bounds[code+1]-1]])) for code, chromosome in enumerate(windows.chroms)]
+    try:
+        bw = pyBigWig.open(fileName, 'w')
+    except RuntimeError:
+        raise IOError(2, 'Cannot open bigwig file for writing', fileName)
+    # Zoom levels are calculated by pyBigWig when the file is closed
+    bw.addHeader(chromSizes, maxZooms=10)
+    for code, chromosome in enumerate(windows.chroms):
+        chrOrder = order[bounds[code]:bounds[code+1]]
+        try:
+            bw.addEntries([chromosome] * len(chrOrder), windows.starts[chrOrder], ends=windows.ends[chrOrder], values=ratios[chrOrder])
+        except RuntimeError:
+            bw.close()
+            raise MfaseqError('The windows on {0} could not be written to bigwig file {1}. Windows must not overlap.'.format(chromosome, fileName))
+    bw.close()
+
+
+def chromosomeRuns(chromCodes):
+    """Returns the index of the first and of the last window of the run of windows on the same chromosome that each
+    window belongs to"""
+    n = len(chromCodes)
+    firsts = np.flatnonzero(np.concatenate(([True], chromCodes[1:] != chromCodes[:-1]))) if n else np.zeros(0, dtype=np.int64)
+    lengths = np.diff(np.append(firsts, n))
+    return np.repeat(firsts, lengths), np.repeat(firsts + lengths - 1, lengths)
+
+
+def rollingMean(values, chromCodes, width):
+    """Means of the values in a window of width values centred on each one, with the first and last values of each
+    chromosome repeated beyond its ends. Computed from cumulative sums, in time proportional to the number of values
+    whatever the width."""
+    half = width // 2
+    index = np.arange(len(values))
+    first, last = chromosomeRuns(chromCodes)
+    lo = np.maximum(index - half, first)
+    hi = np.minimum(index + half, last)
+    sums = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+    # Windows that reach past the end of a chromosome count its first or last value once for each missing window
+    totals = sums[hi + 1] - sums[lo] + (lo - (index - half)) * values[first] + ((index + half) - hi) * values[last]
+    return totals / width
+
+
+def rollingMedian(values, chromCodes, width):
+    """Medians of the values in a window of width values centred on each one, with the first and last values of each
+    chromosome repeated beyond its ends. width should be odd. The windows are gathered into a block of rows at a time,
+    each partitioned around its middle value, with about WRITE_CHUNK values in a block whatever the width."""
+    half = width // 2
+    first, last = chromosomeRuns(chromCodes)
+    offsets = np.arange(-half, half + 1)
+    medians = np.empty(len(values), dtype=np.float64)
+    rows = max(1, WRITE_CHUNK // width)
+    for block in range(0, len(values), rows):
+        index = np.arange(block, min(block + rows, len(values)))
+        gathered = values[np.clip(index[:, None] + offsets, first[index, None], last[index, None])]
+        medians[index] = np.partition(gathered, half, axis=1)[:, half]
+    return medians
+
+
+def zScores(values):
+    """Number of standard deviations of each value from the mean of all the values"""
+    if not len(values):
+        return np.asarray(values, dtype=np.float64)
+    std = values.std()
+    return (values - values.mean()) / std if std > 0 else np.zeros(len(values), dtype=np.float64)
+
+
+def processRatios(windows, order, ratios, smooth=None, smoothWindows=5, zscore=False):
+    """Returns the ratios smoothed and/or converted to z-scores, with the windows taken in output order"""
+    values = ratios[order]
+    codes = windows.chromCodes[order]
+    if smooth == 'mean':
+        values = rollingMean(values, codes, smoothWindows)
+    elif smooth == 'median':
+        values = rollingMedian(values, codes, smoothWindows)
+    if zscore:
+        values = zScores(values)
+    processed = ratios.astype(np.float64)
+    processed[order] = values
+    return processed
+
+
+def callPeaks(values, chromCodes, threshold=2.0, minWindows=3):
+    """Finds the runs of at least minWindows consecutive values on the same chromosome that are at least threshold
+    standard deviations above the mean of all the values.
+
+    Returns the indexes of the first and last window of each run and of the window with its highest value.
+    """
+    above = zScores(values) >= threshold
+    first, last = chromosomeRuns(chromCodes)
+    index = np.arange(len(values))
+    starts = np.flatnonzero(above & ((index == first) | ~np.concatenate(([False], above[:-1]))))
+    ends = np.flatnonzero(above & ((index == last) | ~np.concatenate((above[1:], [False]))))
+    keep = ends - starts + 1 >= minWindows
+    starts, ends = starts[keep], ends[keep]
+    if not len(starts):
+        return starts, ends, starts
+    # Each run's values laid end to end; the summit is the first window of each run with the run's highest value
+    lengths = ends - starts + 1
+    offsets = np.cumsum(lengths) - lengths
+    runValues = values[np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())]
+    isMax = runValues == np.repeat(np.maximum.reduceat(runValues, offsets), lengths)
+    maxima = np.flatnonzero(isMax)
+    summits = maxima[np.searchsorted(maxima, offsets)] - offsets + starts
+    return starts, ends, summits
+
+
+def writePeaks(windows, order, values, fileName, threshold=2.0, minWindows=3):
+    """Writes the regions found by callPeaks to a bed file of chromosome, start, end, highest value and the start of
+    the window with the highest value"""
+    codes = windows.chromCodes[order]
+    starts, ends, summits = callPeaks(values[order], codes, threshold, minWindows)
+    with open(fileName, 'w') as fileHandle:
+        for code, start, end, value, summit in zip(codes[starts].tolist(), windows.starts[order[starts]].tolist(), windows.ends[order[ends]].tolist(),
+                                                   values[order[summits]].tolist(), windows.starts[order[summits]].tolist()):
+            fileWriter('{0}\t{1}\t{2}\t{3:4.5f}\t{4}'.format(windows.chroms[code], start, end, value, summit), fileHandle)
+    return len(starts)
+
+
+def writeNpz(windows, order, ratios, fileName):
+    """Writes the windows in output order as arrays, with the windows of chroms[i] at chromBounds[i]:chromBounds[i+1]"""
+    bounds, firstLines = chromosomeBounds(windows, order)
+    with open(fileName, 'wb') as f:
+        np.savez_compressed(f, chroms=np.array(windows.chroms), chromBounds=bounds, starts=windows.starts[order], ends=windows.ends[order],
+                            ratios=ratios[order].astype(np.float32))
+
+
+# Arguments of chromosomeBlocks for --byChromosome. Set by _setChromosomeJob when each worker process starts, so forked
+# processes share them and others receive a copy
+_chromosomeJob = {}
+
+def _setChromosomeJob(job):
+    _chromosomeJob.clear()
+    _chromosomeJob.update(job)
+
+def _chromosomeText(code):
+    return ''.join('\n'.join(lines) + '\n' for lines in chromosomeBlocks(code=code, **_chromosomeJob))
+
+
+def parallelWriteRatios(windows, order, ratios, fileFormat, fileHandle, processes):
+    """As writeRatios, formatting each chromosome in a pool of processes and writing them in the original order"""
+    bounds, firstLines = chromosomeBounds(windows, order)
+    job = dict(windows=windows, order=order, ratios=ratios, fileFormat=fileFormat, bounds=bounds, firstLines=firstLines)
+    chroms = range(len(windows.chroms))
+    with Pool(max(1, min(processes, len(chroms))), initializer=_setChromosomeJob, initargs=(job,)) as pool:
+        for text in pool.imap(_chromosomeText, chroms, chunksize=max(1, len(chroms) // (processes * 4))):
+            fileHandle.write(text)
+
+
+def writeStreamBlock(windows, ratios, fileFormat, fileHandle, lastCode):
+    """Writes a block of windows in input order, starting a new wig section whenever the chromosome changes"""
+    codes = windows.chromCodes
+    if not len(codes):
+        return lastCode
+    changes = np.flatnonzero(np.diff(codes)) + 1
+    if codes[0] != lastCode:
+        changes = np.concatenate(([0], changes))
+    bounds = np.unique(np.concatenate(([0], changes, [len(codes)])))
+    for first, last in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        chromosome = windows.chroms[codes[first]]
+        if fileFormat == 'wig' and first in changes:
+            fileWriter(wigHeader(chromosome, windows.starts[first], windows.ends[first]), fileHandle)
+        blockWriter(formatLines(chromosome, windows.starts[first:last], windows.ends[first:last], ratios[first:last], fileFormat), fileHandle)
+    return codes[-1]
+
+
+def streamSums(fileE, fileG):
+    sumE = 0
+    sumG = 0
+    for lineNo, windowsE, windowsG in readBedPairs(fileE, fileG):
+        checkWindows(windowsE, windowsG, lineNo)
+        sumE += int(windowsE.values.sum())
+        sumG += int(windowsG.values.sum())
+    return sumE, sumG
+
+
+def streamRatios(fileE, fileG, gConversionFactor, fileFormat, fileHandle):
+    lastCode = -1
+    for lineNo, windowsE, windowsG in readBedPairs(fileE, fileG):
+        with metrics.stage('compute'):
+            checkWindows(windowsE, windowsG, lineNo)
+            ratios = computeRatios(windowsE.values, windowsG.values, gConversionFactor)
+            checkRatios(windowsE, ratios)
+        with metrics.stage('write'):
+            lastCode = writeStreamBlock(windowsE, ratios, fileFormat, fileHandle, lastCode)
+        metrics.count('windows', len(windowsE))
+
+
+def ratioTrack(windowsE, windowsG, sums, normalise, fileFormat, fileHandle, processes=1, process=None):
+    """Computes and writes the ratios, returning the order in which the windows are written and the values written.
+
+    For binary formats fileHandle is the name of the output file. process, if given, is called with the windows, their
+    order and the ratios, and returns the values to write in place of the ratios.
+    """
+    with metrics.stage('compute'):
+        gConversionFactor = conversionFactor(sums[0], sums[1], normalise)
+        ratios = computeRatios(windowsE.values, windowsG.values, gConversionFactor)
+        checkRatios(windowsE, ratios)
+        order = windowOrder(windowsE)
+    if process:
+        with metrics.stage('process'):
+            ratios = process(windowsE, order, ratios)
+    with metrics.stage('write'):
+        if fileFormat == 'bigwig':
+            writeBigWig(windowsE, order, ratios, fileHandle)
+        elif fileFormat == 'npz':
+            writeNpz(windowsE, order, ratios, fileHandle)
+        elif processes > 1:
+            parallelWriteRatios(windowsE, order, ratios, fileFormat, fileHandle, processes)
+        else:
+            writeRatios(windowsE, order, ratios, fileFormat, fileHandle)
+    metrics.count('windows', len(order))
+    return order, ratios
+
+
+def readManifest(fileName, fileFormat):
+    pairs = []
+    # Line on which each output file is first given, so two pairs are not written to the same file
+    outputs = {}
+    with open(fileName) as f:
+        for lineNo, line in enumerate(f, 1):
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            columns = line.split('\t')
+            if len(columns) == 2:
+                stems = [os.path.splitext(os.path.basename(column))[0] for column in columns]
+                columns.append('{0}_{1}.{2}'.format(stems[0], stems[1], EXTENSIONS[fileFormat]))
+            if len(columns) != 3:
+                raise MfaseqError("Line {0} of manifest {1} should have two or three tab separated columns".format(lineNo, fileName))
+            output = os.path.abspath(columns[2])
+            if output in outputs:
+                raise MfaseqError("Line {0} of manifest {1} has the same output file as line {2}: {3}. Please give each pair a different output file name "
+                                  "in a third column".format(lineNo, fileName, outputs[output], columns[2]))
+            outputs[output] = lineNo
+            pairs.append(tuple(columns))
+    return pairs
+
+
+# Bed files read for --manifest, keyed by file name. The cache is filled before the pool of pairs is started and set
+# in each worker by _setWindowCache, so forked processes share it and others receive a copy; a file that could not be
+# read is stored as its exception
+_windowCache = {}
+
+def _setWindowCache(cache):
+    _windowCache.clear()
+    _windowCache.update(cache)
+
+def _readBedOrError(fileName, reader=readBed):
+    try:
+        return reader(fileName)
+    except (IOError, ValueError) as e:
+        return e
+
+def cachedReadBed(fileName, reader=readBed):
+    if fileName not in _windowCache:
+        _windowCache[fileName] = _readBedOrError(fileName, reader)
+    if isinstance(_windowCache[fileName], Exception):
+        raise _windowCache[fileName]
+    return _windowCache[fileName]
+
+
+def bedRatios(fileE, fileG, normalise=True, sums=None, reader=readBed, process=None):
+    """Returns the windows of the first of a pair of bed files, in output order, and the ratio of each window.
+
+    The windows are sorted by start within each chromosome, with the chromosomes in order of first appearance. process
+    is as for ratioTrack, e.g. partial(processRatios, smooth='median').
+    """
+    windowsE, windowsG = readBedPair(fileE, fileG, reader=reader)
+    sumE, sumG = sums if sums else (int(windowsE.values.sum()), int(windowsG.values.sum()))
+    ratios = computeRatios(windowsE.values, windowsG.values, conversionFactor(sumE, sumG, normalise))
+    checkRatios(windowsE, ratios)
+    order = windowOrder(windowsE)
+    if process:
+        ratios = process(windowsE, order, ratios)
+    return windowsE.take(order), ratios[order]
+
+
+def ratioFile(fileE, fileG, out, normalise=True, fileFormat='bed', sums=None, reader=readBed, process=None):
+    """Computes the ratio track of a pair of bed files and writes it to the file out"""
+    windowsE, windowsG = readBedPair(fileE, fileG, reader=reader)
+    sums = sums if sums else (int(windowsE.values.sum()), int(windowsG.values.sum()))
+    if fileFormat in BINARY_FORMATS:
+        ratioTrack(windowsE, windowsG, sums, normalise, fileFormat, out, process=process)
+    else:
+        with open(out, 'w') as fileHandle:
+            ratioTrack(windowsE, windowsG, sums, normalise, fileFormat, fileHandle, process=process)
+
+
+def errorMessage(e):
+    if isinstance(e, IOError):
+        return "ERROR: Cannot open file: '{0}: {1}'\n".format(e.strerror, e.filename)
+    if isinstance(e, MfaseqError):
+        return "ERROR: {0}\n".format(e)
+    return "ERROR: Cannot parse bed file: {0}\n".format(e)
+
+
+def _batchPair(pair, normalise, fileFormat, reader=readBed, process=None):
+    fileE, fileG, out = pair
+    try:
+        ratioFile(fileE, fileG, out, normalise, fileFormat, reader=partial(cachedReadBed, reader=reader), process=process)
+    except (IOError, ValueError, MfaseqError) as e:
+        return errorMessage(e)
+    return None
+
+
+def preloadBeds(fileNames, processes, reader=readBed):
+    """Reads bed files into the cache used by cachedReadBed in a pool of processes"""
+    fileNames = [fileName for fileName in dict.fromkeys(fileNames) if fileName not in _windowCache]
+    if processes > 1 and len(fileNames) > 1:
+        with Pool(min(processes, len(fileNames))) as pool:
+            _windowCache.update(zip(fileNames, pool.starmap(_readBedOrError, [(fileName, reader) for fileName in fileNames])))
+
+
+def batchRatios(pairs, normalise, fileFormat, processes, reader=readBed, process=None):
+    """Computes the ratio track for each (file1, file2, out) pair, returning a list of error messages"""
+    # Stages run in the worker processes are not recorded, only the time spent reading and processing all the pairs
+    try:
+        with metrics.stage('preload'):
+            preloadBeds([fileName for pair in pairs for fileName in pair[:2]], processes, reader)
+        with metrics.stage('pairs'), Pool(max(1, min(processes, len(pairs))), initializer=_setWindowCache, initargs=(dict(_windowCache),)) as pool:
+            errors = pool.starmap(_batchPair, [(pair, normalise, fileFormat, reader, process) for pair in pairs])
+    finally:
+        # The files may change before the next call in the same process
+        _windowCache.clear()
+    metrics.count('pairs', len(pairs))
+    return ['{0}/{1}: {2}'.format(pair[0], pair[1], error) for pair, error in zip(pairs, errors) if error]
+
+
+def main(args=None):
+    args = args or get_args()
+    try:
+        runRatios(args)
+    except (IOError, ValueError, MfaseqError) as e:
+        raise SystemExit(errorMessage(e))
+
+
+def ratioProcessor(args):
+    if args.smooth or args.zscore:
+        return partial(processRatios, smooth=args.smooth, smoothWindows=args.smoothWindows, zscore=args.zscore)
+    return None
+
+
+def runRatios(args):
+    if args.manifest:
+        pairs = readManifest(args.manifest, args.format)
+        errors = batchRatios(pairs, args.noNormalise, args.format, args.processes, bedReader(args), ratioProcessor(args))
+        for error in errors:
+            sys.stderr.write(error)
+        if errors:
+            raise MfaseqError("{0} of {1} pairs in {2} could not be processed".format(len(errors), len(pairs), args.manifest))
+        return
+
+    fileE = args.file1
+    fileG = args.file2
+
+    fileHandle = sys.stdout
+
+    if args.out and args.format not in BINARY_FORMATS:
+        fileHandle = open(args.out,"w")
+
+    sums = readSums(args.sums) if args.sums else None
+
+    if args.stream:
+        with metrics.stage('sums'):
+            sumE, sumG = sums if sums else streamSums(fileE, fileG)
+    else:
+        reader = bedReader(args)
+        try:
+            if args.byChromosome:
+                preloadBeds([fileE, fileG], args.processes, reader)
+                reader = partial(cachedReadBed, reader=reader)
+            windowsE, windowsG = readBedPair(fileE, fileG, reader=reader)
+        finally:
+            _windowCache.clear()
+        sumE, sumG = sums if sums else (int(windowsE.values.sum()), int(windowsG.values.sum()))
+
+    if args.writeSums:
+        writeSums(args.writeSums, sumE, sumG)
+
+    if args.stream:
+        streamRatios(fileE, fileG, conversionFactor(sumE, sumG, args.noNormalise), args.format, fileHandle)
+    else:
+        output = args.out if args.format in BINARY_FORMATS else fileHandle
+        order, values = ratioTrack(windowsE, windowsG, (sumE, sumG), args.noNormalise, args.format, output, args.processes if args.byChromosome else 1,
+                                   ratioProcessor(args))
+        if args.peaks:
+            with metrics.stage('peaks'):
+                metrics.count('peaks', writePeaks(windowsE, order, values, args.peaks, args.peakThreshold, args.peakMinWindows))
+
+    if fileHandle is not sys.stdout:
         fileHandle.close()
 
 if __name__ == '__main__':
-    main()
+    instrumentation.run(main, get_args())
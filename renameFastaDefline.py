@@ -1,54 +1,410 @@
 #!/usr/bin/env python3
 
-from Bio import SeqIO
 import argparse
 import logging
+import mmap
+import os
+import shutil
+import struct
+import time
+from array import array
+from multiprocessing import Pool
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-sh = logging.StreamHandler()
-sh.setFormatter(logging.Formatter('%(levelname)s - %(asctime)s - %(message)s'))
-logger.addHandler(sh)
-
-parser = argparse.ArgumentParser(description='Rename fasta file deflines from a mapping file')
-parser.add_argument('--fastaFile', required=True, help='Input fasta file')
-parser.add_argument('--mappingFile', required=True, help='Comma separated file containing record ids from the fasta file and their replacements')
-args = parser.parse_args()
-
-logger.info('Renaming deflines in fasta file {} using mapping file{}\n'.format(args.fastaFile, args.mappingFile))
-
-outputFile = 'renamed_{}'.format(args.fastaFile)
-logger.info('Output will be written to {}.\n'.format(outputFile))
-
-try:
-    outputh = open(outputFile, 'w')
-except FileNotFoundError:
-    logger.error('Cannot open output file {}. Please try again\n'.format(outputFile))
-    raise SystemExit(1)
-
-mapping = {}
-try:
-    data = open(args.mappingFile)
-except FileNotFoundError:
-    logger.error('Cannot open mapping file {}. Please try again\n'.format(args.mappingFile))
-    raise SystemExit(1)
-
-for line in data:
-    old, new = line.rstrip().split(',')
-    mapping[old] = new
-
-try:
-    for record in SeqIO.parse(args.fastaFile, 'fasta'):
-        if record.id in mapping:
-            record.id = mapping[record.id]
-            record.description = ''
-            SeqIO.write(record, outputh, 'fasta')
+import instrumentation
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+# Renamed records are written with sequence lines of this width, as Biopython does
+WRAP = 60
+WRITE_BUFFER = 1 << 20
+# First bytes of a mapping index written by writeMappingIndex
+INDEX_MAGIC = b'RENAMEFASTAIDX1\n'
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Rename fasta file deflines from a mapping file')
+    parser.add_argument('--fastaFile', nargs='+', help='Input fasta file(s). Each file is written to renamed_FASTAFILE')
+    parser.add_argument('--mappingFile', required=True, help='Comma separated file containing record ids from the fasta file and their replacements, or an index of one written with --buildIndex')
+    parser.add_argument('--buildIndex', help='Write an index of the mapping file to this file, which can be given as --mappingFile in later runs to start without reading the mapping')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Number of fasta files, or parts of large fasta files, renamed at the same time')
+    parser.add_argument('--splitSize', type=int, default=256, help='Fasta files larger than this number of MB are split into parts of about this size, on record boundaries, which are renamed at the same time')
+    parser.add_argument('--useIndex', action='store_true', help='Read only the records in the mapping from each fasta file, using its samtools style index FASTAFILE.fai, which is built if it does not exist or is older than the fasta file. An index of each output file is also written to renamed_FASTAFILE.fai')
+    instrumentation.addArguments(parser)
+    args = parser.parse_args()
+    if not args.fastaFile and not args.buildIndex:
+        parser.error('--fastaFile is required unless --buildIndex is given')
+    if args.processes < 1 or args.splitSize < 1:
+        parser.error('--processes and --splitSize must be at least 1')
+    return args
+
+
+def readMapping(fileName):
+    """Reads a comma separated mapping file, or a mapping index if the file is one."""
+    with open(fileName, 'rb') as data:
+        if data.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            return MappingIndex(fileName)
+    mapping = {}
+    with open(fileName) as data:
+        for line in data:
+            old, new = line.rstrip().split(',')
+            mapping[old.encode('utf-8')] = new.encode('utf-8')
+    return mapping
+
+
+def writeMappingIndex(mapping, fileName):
+    """Writes a mapping as its number of ids, the offsets of the ids and of their replacements, and the ids and
+    replacements themselves, with the ids in sorted order so they can be searched in place by MappingIndex."""
+    keys = sorted(mapping)
+    keyOffsets, valueOffsets = array('Q', [0]), array('Q', [0])
+    for key in keys:
+        keyOffsets.append(keyOffsets[-1] + len(key))
+        valueOffsets.append(valueOffsets[-1] + len(mapping[key]))
+    with open(fileName + '.tmp', 'wb') as indexh:
+        indexh.write(INDEX_MAGIC + struct.pack('=Q', len(keys)))
+        keyOffsets.tofile(indexh)
+        valueOffsets.tofile(indexh)
+        indexh.write(b''.join(keys))
+        indexh.write(b''.join(mapping[key] for key in keys))
+    os.replace(fileName + '.tmp', fileName)
+
+
+class MappingIndex(object):
+    """Mapping of ids to their replacements read from an index written by writeMappingIndex.
+
+    The index is memory mapped rather than loaded, so it can be opened straight away however many ids it holds, and
+    its pages are shared by the processes renaming fasta files.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as indexh:
+            self.buffer = mmap.mmap(indexh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = struct.unpack_from('=Q', self.buffer, len(INDEX_MAGIC))[0]
+        start = len(INDEX_MAGIC) + 8
+        size = (self.count + 1) * 8
+        self.keyOffsets = memoryview(self.buffer)[start:start + size].cast('Q')
+        self.valueOffsets = memoryview(self.buffer)[start + size:start + 2 * size].cast('Q')
+        self.keyStart = start + 2 * size
+        self.valueStart = self.keyStart + self.keyOffsets[self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __reduce__(self):
+        # Processes that are not forked open the index again rather than receiving a copy of it
+        return MappingIndex, (self.fileName,)
+
+    def _key(self, i):
+        return self.buffer[self.keyStart + self.keyOffsets[i]:self.keyStart + self.keyOffsets[i+1]]
+
+    def get(self, key, default=None):
+        # Binary search of the sorted ids
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key(lo) == key:
+            return self.buffer[self.valueStart + self.valueOffsets[lo]:self.valueStart + self.valueOffsets[lo+1]]
+        return default
+
+
+def fastaRecords(buffer, start=0, size=None):
+    """Yields the offsets of the header line, the sequence and the end of each record in a fasta file, or in the
+    part of it from start to size, which should begin with a record."""
+    size = len(buffer) if size is None else size
+    if start < size and buffer[start:start+1] != b'>':
+        raise ValueError('The fasta file does not start with a header line')
+    while start < size:
+        seqStart = buffer.find(b'\n', start, size) + 1 or size
+        end = buffer.find(b'\n>', seqStart - 1, size)
+        end = size if end < 0 else end + 1
+        yield start, seqStart, end
+        start = end
+
+
+def isWrapped(sequence, width=WRAP):
+    """Checks that the lines of a sequence, except the last, are width long and contain no whitespace."""
+    content = sequence[:-1] if sequence.endswith(b'\n') else sequence
+    breaks = content[width::width + 1]
+    return (len(content) % (width + 1) != 0 and breaks.count(b'\n') == len(breaks) == content.count(b'\n')
+            and not (b' ' in content or b'\t' in content or b'\r' in content))
+
+
+def sequenceLines(sequence):
+    # Sequences already wrapped at WRAP are copied to the output as they are
+    if not sequence or sequence.endswith(b'\n') and isWrapped(sequence):
+        return sequence
+    if isWrapped(sequence):
+        return sequence + b'\n'
+    # Otherwise whitespace is removed from the sequence, which is then wrapped again
+    sequence = sequence.translate(None, b' \t\r\n')
+    return b''.join(sequence[i:i + WRAP] + b'\n' for i in range(0, len(sequence), WRAP))
+
+
+def renameFasta(fastaFile, outputFile, mapping, start=0, end=None):
+    """Writes the records of a fasta file that are in the mapping, with their new ids as the deflines.
+
+    The input is memory mapped and only the header lines are parsed, so the sequences of the records are copied
+    without being split into lines, unless they need to be wrapped again. If start and end are given, only the
+    records between these offsets are written. Returns the number of records read and the number written.
+    """
+    with open(fastaFile, 'rb') as fastah, open(outputFile, 'wb', buffering=WRITE_BUFFER) as outputh:
+        buffer = mmap.mmap(fastah.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fastah.fileno()).st_size else b''
+        try:
+            return renameRecords(buffer, outputh, mapping, start, end)
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+
+
+def renameRecords(buffer, outputh, mapping, start=0, end=None):
+    """Writes the records in a buffer of fasta text that are in the mapping to outputh, returning the number of records
+    read and the number written."""
+    records = renamed = 0
+    for recordStart, seqStart, recordEnd in fastaRecords(buffer, start, end):
+        records += 1
+        title = buffer[recordStart+1:seqStart].rstrip()
+        recordId = title.split(None, 1)[0] if title else b''
+        newId = mapping.get(recordId)
+        if newId is not None:
+            outputh.write(b'>' + newId + b'\n')
+            outputh.write(sequenceLines(buffer[seqStart:recordEnd]))
+            renamed += 1
         else:
-            logger.warning('Record {} in the fasta file cannot be found in the mapping file. This record will be written in the output fasta file with the original id\n'.format(record.id))
-except FileNotFoundError:
-    logger.error('Cannot open fasta file {}. Please try again\n'.format(args.fastaFile))
-    raise SystemExit(1)
+            logger.warning('Record {} in the fasta file cannot be found in the mapping file. This record will be written in the output fasta file with the original id\n'.format(recordId.decode('utf-8')))
+    return records, renamed
+
+
+def renameFastaStream(inputh, outputh, mapping, blockSize=WRITE_BUFFER):
+    """As renameFasta, for binary file objects such as pipes, which are read in blocks of complete records.
+
+    Returns the number of records read and the number written.
+    """
+    records = renamed = 0
+    pending = bytearray()
+    for block in iter(lambda: inputh.read(blockSize), b''):
+        # Everything before the last header in pending is complete records; the text before the new block has no header
+        searchFrom = max(0, len(pending) - 1)
+        pending += block
+        end = pending.rfind(b'\n>', searchFrom) + 1
+        if end:
+            counts = renameRecords(bytes(pending[:end]), outputh, mapping)
+            records, renamed = records + counts[0], renamed + counts[1]
+            del pending[:end]
+    counts = renameRecords(bytes(pending), outputh, mapping)
+    return records + counts[0], renamed + counts[1]
+
+
+def buildFai(fastaFile):
+    """Returns the samtools style index of a fasta file: the name, length, sequence offset, bases per line and bytes
+    per line of each record. Records whose lines are not all the same length, except the last, cannot be indexed."""
+    entries = []
+    with open(fastaFile, 'rb') as fastah:
+        buffer = mmap.mmap(fastah.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fastah.fileno()).st_size else b''
+        try:
+            for start, seqStart, end in fastaRecords(buffer):
+                title = buffer[start+1:seqStart].rstrip()
+                name = title.split(None, 1)[0] if title else b''
+                sequence = buffer[seqStart:end]
+                lineWidth = sequence.find(b'\n') + 1 or len(sequence)
+                lineBases = lineWidth - 1 if sequence[lineWidth-1:lineWidth] == b'\n' else lineWidth
+                if sequence and not isWrapped(sequence, lineBases):
+                    raise ValueError('The lines of record {} are not all the same length'.format(name.decode('utf-8')))
+                entries.append((name, len(sequence) - sequence.count(b'\n'), seqStart, lineBases, lineWidth))
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+    return entries
+
+
+def readFai(faiFile):
+    with open(faiFile, 'rb') as faih:
+        return [(fields[0],) + tuple(int(field) for field in fields[1:5]) for fields in (line.split(b'\t') for line in faih)]
+
+
+def writeFai(entries, faiFile):
+    with open(faiFile + '.tmp', 'wb') as faih:
+        faih.write(b''.join(b'%s\t%d\t%d\t%d\t%d\n' % entry for entry in entries))
+    os.replace(faiFile + '.tmp', faiFile)
+
+
+def fastaIndex(fastaFile):
+    """Reads the index of a fasta file, first building it if it does not exist or is older than the fasta file."""
+    faiFile = fastaFile + '.fai'
+    if os.path.exists(faiFile) and os.path.getmtime(faiFile) >= os.path.getmtime(fastaFile):
+        return readFai(faiFile)
+    logger.info('Writing index of fasta file {} to {}\n'.format(fastaFile, faiFile))
+    entries = buildFai(fastaFile)
+    writeFai(entries, faiFile)
+    return entries
+
+
+def renameIndexed(fastaFile, outputFile, mapping):
+    """Writes the records of a fasta file that are in the mapping, with their new ids as the deflines, reading only
+    those records at the offsets given by the index of the fasta file.
+
+    The index of the output file is written as well, from the lengths of the records that are written. Returns the
+    number of records in the index and the number written.
+    """
+    entries = fastaIndex(fastaFile)
+    outputEntries = []
+    position = 0
+    with open(fastaFile, 'rb') as fastah, open(outputFile, 'wb', buffering=WRITE_BUFFER) as outputh:
+        buffer = mmap.mmap(fastah.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fastah.fileno()).st_size else b''
+        try:
+            for name, length, offset, lineBases, lineWidth in entries:
+                newId = mapping.get(name)
+                if newId is None:
+                    logger.warning('Record {} in the fasta file cannot be found in the mapping file. This record will be written in the output fasta file with the original id\n'.format(name.decode('utf-8')))
+                    continue
+                fullLines, lastBases = divmod(length, lineBases) if lineBases else (0, 0)
+                sequence = sequenceLines(buffer[offset:offset + fullLines * lineWidth + lastBases])
+                header = b'>' + newId + b'\n'
+                outputh.write(header)
+                outputh.write(sequence)
+                position += len(header)
+                lineBases = min(length, WRAP)
+                outputEntries.append(((newId.split(None, 1) or [b''])[0], length, position, lineBases, lineBases + 1 if length else 0))
+                position += len(sequence)
+        finally:
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+    writeFai(outputEntries, outputFile + '.fai')
+    return len(entries), len(outputEntries)
+
+
+def splitFasta(fastaFile, splitSize):
+    """Returns the offsets of parts of a fasta file of about splitSize bytes that start at a record."""
+    with open(fastaFile, 'rb') as fastah:
+        size = os.fstat(fastah.fileno()).st_size
+        if size <= splitSize:
+            return [(0, size)]
+        with mmap.mmap(fastah.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            bounds = [0]
+            while bounds[-1] + splitSize < size:
+                bound = buffer.find(b'\n>', bounds[-1] + splitSize - 1)
+                if bound < 0:
+                    break
+                bounds.append(bound + 1)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Mapping used by the processes renaming fasta files. It is set by _setMapping when each process starts, so forked
+# processes inherit it and others receive a copy of it, rather than each reading the mapping file
+_mapping = {}
+
+def _setMapping(mapping):
+    global _mapping
+    _mapping = mapping
+
+
+def _renameJob(fastaFile, outputFile, start, end, useIndex=False):
+    """Renames a fasta file or a part of one, returning an error message or None, the numbers of records read and
+    written and the time taken, which are recorded by the parent process as the metrics of a pool process are lost."""
+    jobStart = time.perf_counter()
+    try:
+        if useIndex:
+            try:
+                counts = renameIndexed(fastaFile, outputFile, _mapping)
+                return (None,) + counts + (time.perf_counter() - jobStart,)
+            except ValueError as e:
+                logger.warning('Cannot index fasta file {}; all of it will be read. {}\n'.format(fastaFile, e))
+        counts = renameFasta(fastaFile, outputFile, _mapping, start, end)
+    except FileNotFoundError as e:
+        if e.filename == outputFile:
+            return 'Cannot open output file {}. Please try again\n'.format(outputFile), 0, 0, 0.0
+        return 'Cannot open fasta file {}. Please try again\n'.format(fastaFile), 0, 0, 0.0
+    except ValueError as e:
+        return 'Cannot read fasta file {}. {}\n'.format(fastaFile, e), 0, 0, 0.0
+    return (None,) + counts + (time.perf_counter() - jobStart,)
+
+
+def batchRename(fastaFiles, mapping, processes=1, splitSize=256 << 20, useIndex=False):
+    """Renames each fasta file to renamed_FASTAFILE in a pool of processes, returning a list of error messages.
+
+    Files larger than splitSize are renamed in parts, which are then joined, unless they are read using their index.
+    """
+    _setMapping(mapping)
+    jobs = []
+    parts = {}
+    for fastaFile in fastaFiles:
+        outputFile = 'renamed_{}'.format(fastaFile)
+        try:
+            ranges = [(0, None)] if useIndex else splitFasta(fastaFile, splitSize)
+        except FileNotFoundError:
+            ranges = [(0, None)]
+        if len(ranges) == 1:
+            jobs.append((fastaFile, outputFile) + ranges[0] + (useIndex,))
+        else:
+            parts[outputFile] = ['{0}.part{1}'.format(outputFile, i) for i in range(len(ranges))]
+            jobs.extend((fastaFile, part) + bounds for part, bounds in zip(parts[outputFile], ranges))
+    with metrics.stage('rename'):
+        if processes > 1 and len(jobs) > 1:
+            with Pool(min(processes, len(jobs)), initializer=_setMapping, initargs=(mapping,)) as pool:
+                results = pool.starmap(_renameJob, jobs)
+        else:
+            results = [_renameJob(*job) for job in jobs]
+    for error, records, renamed, seconds in results:
+        metrics.record('renameJob', seconds)
+        metrics.count('records', records)
+        metrics.count('renamed', renamed)
+    errors = [result[0] for result in results if result[0]]
+    failed = set(job[1] for job, result in zip(jobs, results) if result[0])
+    with metrics.stage('joinParts'):
+        for outputFile, partFiles in parts.items():
+            if not failed.intersection(partFiles):
+                with open(outputFile, 'wb') as outputh:
+                    for part in partFiles:
+                        with open(part, 'rb') as parth:
+                            shutil.copyfileobj(parth, outputh, WRITE_BUFFER)
+            for part in partFiles:
+                if os.path.exists(part):
+                    os.remove(part)
+    for fastaFile in fastaFiles:
+        if os.path.exists(fastaFile):
+            metrics.count('inputBytes', os.path.getsize(fastaFile))
+    return errors
+
+
+def main(args=None):
+    args = args or get_args()
+
+    try:
+        with metrics.stage('readMapping'):
+            mapping = readMapping(args.mappingFile)
+    except FileNotFoundError:
+        logger.error('Cannot open mapping file {}. Please try again\n'.format(args.mappingFile))
+        raise SystemExit(1)
+
+    if args.buildIndex:
+        if isinstance(mapping, MappingIndex):
+            logger.error('Mapping file {} is already an index\n'.format(args.mappingFile))
+            raise SystemExit(1)
+        logger.info('Writing index of mapping file {} to {}\n'.format(args.mappingFile, args.buildIndex))
+        with metrics.stage('buildIndex'):
+            writeMappingIndex(mapping, args.buildIndex)
+
+    if not args.fastaFile:
+        return
+
+    for fastaFile in args.fastaFile:
+        logger.info('Renaming deflines in fasta file {} using mapping file{}\n'.format(fastaFile, args.mappingFile))
+        logger.info('Output will be written to {}.\n'.format('renamed_{}'.format(fastaFile)))
+
+    errors = batchRename(args.fastaFile, mapping, args.processes, args.splitSize << 20, args.useIndex)
+    for error in errors:
+        logger.error(error)
+    if errors:
+        raise SystemExit(1)
+
+    logger.info('Complete! Please find your output at {}\n'.format(', '.join('renamed_{}'.format(fastaFile) for fastaFile in args.fastaFile)))
 
-logger.info('Complete! Please find your output at {}\n'.format(outputFile))
 
-exit()
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(message)s')
+    instrumentation.run(main, get_args())
@@ -2,27 +2,90 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 from argparse import ArgumentParser
 import logging
+import os
+import random
 import re
 import json
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import hashlib
 from time import sleep
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-ch = logging.StreamHandler()
-ch.setFormatter(logging.Formatter('%(levelname)s - %(asctime)s - %(message)s'))
-logger.addHandler(ch)
+import instrumentation
+from instrumentation import metrics
+
+# Files written in the output directory. The manifest is only used by --incremental, and so is the cached metadata
+# except for the organisms of each experiment, which are always reused
+METADATA_CACHE = 'rnaSeqDumpMetadata.json'
+MANIFEST = 'rnaSeqDumpManifest.json'
+
+logger = logging.getLogger(__name__)
+
+
+class RnaSeqDumpError(Exception):
+    """Raised when data cannot be retrieved from a project or written"""
+
+
+def _numpy():
+    # NumPy is only needed for npz output, so it is imported when first used
+    try:
+        import numpy
+    except ImportError:
+        raise RnaSeqDumpError('npz output requires the numpy library. Please install it (e.g., pip install numpy) and try again.')
+    return numpy
 
 
 class RnaSeqParams(object):
 
-    def __init__(self, args, Session):
+    def __init__(self, args, Session, cacheFile=None, cacheTTL=24):
         self.args = args
         self.Session = Session
-        self.organismList = self.getOrganismList()
-        self.experimentNodes = self.getExperimentNodes()
+        self.cacheFile = cacheFile
+        self.cacheTTL = cacheTTL
+        cached = self._readCacheFile().get(self.Session.project, {})
+        # The organisms of an experiment do not change, so they are kept when the rest of the cache expires
+        self.experimentOrganisms = cached.get('experimentOrganisms', {})
+        # Cached metadata is used for up to cacheTTL hours
+        if cached and time.time() - cached['time'] < self.cacheTTL * 3600:
+            logger.info("Using organism list and experiments cached at {0}".format(time.ctime(cached['time'])))
+            self.organismList = cached['organismList']
+            self.experimentNodes = cached['experimentNodes']
+        else:
+            self.organismList = self.getOrganismList()
+            self.experimentNodes = self.getExperimentNodes()
+            self._saveCache()
+
+
+    def _readCacheFile(self):
+        if self.cacheFile and os.path.exists(self.cacheFile):
+            try:
+                with open(self.cacheFile) as f:
+                    return json.load(f)
+            except ValueError as e:
+                logger.warning("Cannot read metadata cache {0}; it will be replaced\n\n{1}".format(self.cacheFile, e))
+        return {}
+
+    def _saveCache(self):
+        if not self.cacheFile:
+            return
+        cache = self._readCacheFile()
+        cache[self.Session.project] = {'time': time.time(), 'organismList': self.organismList, 'experimentNodes': self.experimentNodes,
+                                       'experimentOrganisms': self.experimentOrganisms}
+        try:
+            with open(self.cacheFile + '.tmp', 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+            os.replace(self.cacheFile + '.tmp', self.cacheFile)
+        except OSError as e:
+            logger.warning("Cannot write metadata cache {0}\n\n{1}".format(self.cacheFile, e))
+
+    def setExperimentOrganisms(self, experimentOrganisms):
+        self.experimentOrganisms.update(experimentOrganisms)
+        self._saveCache()
        
 
     def _parseTree(self, json, array):
@@ -36,8 +99,7 @@ class RnaSeqParams(object):
     def getOrganismList(self):
         logger.info("Retrieving organism list")
         url = ('{0}/service/record-types/transcript/searches/GenesByTaxon'.format(self.Session.baseUrl))
-        res = self.Session.session.get(url, verify=True)
-        sleep(0.5)
+        res = self.Session.get(url, verify=True)
         j = self.Session.getDataResponse(res, url)
         organismArray = []
         for parameter in j['searchData']['parameters']:
@@ -48,8 +110,7 @@ class RnaSeqParams(object):
     def getExperimentNodes(self):
         logger.info("Retrieving experiments and nodes")
         url = ('{0}/service/record-types/transcript'.format(self.Session.baseUrl))
-        res = self.Session.session.get(url, verify=True)
-        sleep(0.5)
+        res = self.Session.get(url, verify=True)
         j = self.Session.getDataResponse(res, url)
         datasetNodes = defaultdict(list)
         for key in j['attributes']:
@@ -66,16 +127,143 @@ class RnaSeqParams(object):
 
 class RnaSeqDumper(object):
 
-    def __init__(self, Session, RnaSeqParams, outputDir):
+    chunkSize = 1 << 20
+    writeBuffer = 1 << 20
+    # A probe reports three columns for every gene of every organism, so experiments with fewer samples than this are
+    # requested for all organisms, which costs about as much as the probe alone
+    probeMinSamples = 3
+    trailingSpace = re.compile(rb'[ \t\f\v]+$', re.M)
+    emptyRow = re.compile(rb'\n[^\t\n]*(?:\tN/A)*(?=\n)')
+
+    def __init__(self, Session, RnaSeqParams, outputDir, workers=4, retries=2, outputFormat='txt', matrix=False, manifest=None, allOrganisms=False):
         self.Session = Session
         self.RnaSeqParams = RnaSeqParams
         self.outputDir = outputDir
+        self.retries = retries
+        self.outputFormat = outputFormat
+        self.failures = []
+        self.manifestFile = manifest
+        self.manifest = self._loadManifest(manifest)
+        self.lock = threading.Lock()
+        # Experiment tables are kept in memory only when they are combined into a matrix at the end
+        self.tables = {} if matrix else None
+
+        self.probedOrganisms = {}
+
+        # Up to workers experiments are retrieved at the same time, and each is written as soon as it arrives
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self._retrieveExperiment, experiment, allOrganisms): experiment for experiment in self.RnaSeqParams.experimentNodes}
+                for future in as_completed(futures):
+                    if not future.result():
+                        self.failures.append(futures[future])
+        finally:
+            # Organisms found by the probes are saved once, rather than by each thread
+            if self.probedOrganisms:
+                self.RnaSeqParams.setExperimentOrganisms(self.probedOrganisms)
+        if matrix:
+            with metrics.stage('matrix'):
+                self._writeMatrix()
+
+
+    @staticmethod
+    def _normaliseNewlines(block):
+        if b'\r' in block:
+            block = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        return block
+
+
+    @classmethod
+    def _filterRows(cls, block):
+        """Filters a block of complete lines from a tabular report.
+
+        Trailing whitespace is stripped from every line, and rows where all the values are N/A are dropped, with a
+        regular expression over the whole block rather than line by line.
+        """
+        block = b'\n' + block
+        if any(ending in block for ending in (b' \n', b'\t\n', b'\x0b\n', b'\x0c\n')):
+            block = cls.trailingSpace.sub(b'', block)
+        return cls.emptyRow.sub(b'', block)[1:]
+
+
+    def _writeExperiment(self, experiment, jsonPayLoad):
+        # Failed requests are retried by the session; this retries downloads that are interrupted part way through
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.stage('experiment'):
+                    self._writeData(experiment, jsonPayLoad)
+                self._record(experiment, jsonPayLoad)
+                metrics.count('experiments')
+                return True
+            except RnaSeqDumpError as e:
+                logger.error(e)
+                break
+            except ValueError as e:
+                logger.error('Cannot read data for experiment \"{0}\"\n\n{1}'.format(experiment, e))
+                break
+            except requests.exceptions.RequestException as e:
+                if attempt < self.retries:
+                    logger.warning('Retrying experiment \"{0}\" after error: {1}'.format(experiment, e))
+                    sleep(2 ** attempt)
+        logger.error('Could not retrieve data for experiment \"{0}\"'.format(experiment))
+        return False
+
+
+    def _retrieveExperiment(self, experiment, allOrganisms):
+        """Retrieves an experiment for the organisms it has data for, unless it is unchanged since the last run"""
+        organisms = None if allOrganisms else self._experimentOrganisms(experiment)
+        jsonPayLoad = self._buildPayLoad(self.RnaSeqParams.experimentNodes[experiment], self._organismParameter(organisms))
+        if self._unchanged(experiment, jsonPayLoad):
+            logger.info('Experiment \"{0}\" is unchanged since the last run'.format(experiment))
+            metrics.count('unchangedExperiments')
+            if self.tables is not None:
+                self.tables[experiment] = self._loadTable(self._fileName(experiment))
+            return True
+        return self._writeExperiment(experiment, jsonPayLoad)
+
+
+    def _experimentOrganisms(self, experiment):
+        """Returns the organisms of an experiment, probing for them if they are not already known, or None for all.
+
+        The probe retrieves the organism and the first sample of the experiment for every gene of every organism, and
+        the organisms with a value for that sample are the ones the experiment is then requested for. It is sent by the
+        thread that then retrieves the experiment, so other experiments do not wait for it.
+        """
+        if experiment in self.RnaSeqParams.experimentOrganisms:
+            return self.RnaSeqParams.experimentOrganisms[experiment]
+        if len(self.RnaSeqParams.experimentNodes[experiment]) < self.probeMinSamples:
+            return None
+        with metrics.stage('probe'):
+            organisms = self._probeOrganisms(experiment)
+        if organisms:
+            with self.lock:
+                self.probedOrganisms[experiment] = organisms
+        return organisms
+
+
+    def _probeOrganisms(self, experiment):
+        sampleList = self.RnaSeqParams.experimentNodes[experiment]
+        url = ('{0}/service/record-types/transcript/searches/GenesByTaxon/reports/attributesTabular'.format(self.Session.baseUrl))
+        jsonPayLoad = self._buildPayLoad(['organism'] + sampleList[:1], self._organismParameter(None))
+        logger.info('Finding the organisms of experiment \"{0}\"'.format(experiment))
+        try:
+            res = self.Session.post(url, jsonPayLoad, headers={'Content-Type': 'application/json'})
+            data = self.Session.getDataResponse(res, url, dataType="text")
+        except (RnaSeqDumpError, requests.exceptions.RequestException) as e:
+            logger.warning('Cannot find the organisms of experiment \"{0}\"; it will be retrieved for all organisms\n\n{1}'.format(experiment, e))
+            return None
+        rows = (line.split('\t') for line in data.content.decode('utf-8').splitlines()[1:])
+        organisms = sorted(set(row[1] for row in rows if len(row) > 2 and row[2].strip() != 'N/A'))
+        logger.info('Experiment \"{0}\" has data for {1}'.format(experiment, ', '.join(organisms) or 'no organisms'))
+        return organisms
+
 
-        organismList = ['"'+ organism + '"' for organism in self.RnaSeqParams.organismList]
-        organismList = '[{0}]'.format(','.join(organismList))
-        for experiment, sampleList in self.RnaSeqParams.experimentNodes.items():
-            jsonPayLoad = self._buildPayLoad(sampleList, organismList)
-            self._writeData(experiment, jsonPayLoad)
+    def _organismParameter(self, organisms):
+        # Organisms that are not in the organism list of the search would fail the request, so then all are requested
+        if not organisms or not set(organisms) <= set(self.RnaSeqParams.organismList):
+            organisms = self.RnaSeqParams.organismList
+        organismList = ['"'+ organism + '"' for organism in organisms]
+        return '[{0}]'.format(','.join(organismList))
 
 
     def _buildPayLoad(self, sampleList, organismList):
@@ -93,39 +281,270 @@ class RnaSeqDumper(object):
         url = ('{0}/service/record-types/transcript/searches/GenesByTaxon/reports/attributesTabular'.format(self.Session.baseUrl))
         logger.info("Sending a POST request to {0}".format(url))
         logger.info("JSON payload:\t{0}".format(jsonPayLoad))
-        res = self.Session.session.post(url, jsonPayLoad, headers={'Content-Type': 'application/json'}, stream=True)
+        res = self.Session.post(url, jsonPayLoad, headers={'Content-Type': 'application/json'}, stream=True)
         data = self.Session.getDataResponse(res, url, dataType="text")
         return data
 
 
     def _writeData(self, experiment, payLoad):
         data = self._getData(payLoad, experiment)
-        fileName = experiment.replace(' ', '_').replace('/', '-')
-        fileName = '{0}/{1}.txt'.format(self.outputDir, fileName)
+        fileName = self._fileName(experiment)
         logger.info('Writing data from experiment \"{0}\" to file {1}\n\n'.format(experiment, fileName))
+        partName = fileName + '.part'
         try:
-            outFile = open(fileName, 'w')
-            for line in data.iter_lines():
-                line = line.decode('utf-8').rstrip()
-                data = line.split('\t')
-                # At the moment, we cannot determine from the web services which organism an experiment belongs to
-                # So this retrieves the data for all organisms, and then discards rows where all the values are N/A
-                # We should fix this in web services
-                if all(elem == 'N/A' for elem in data[1:len(data)]):
-                    next
+            # Data is written to a temporary file so an interrupted download does not leave a partial file
+            with open(partName, 'wb', buffering=self.writeBuffer) as outFile:
+                if self.outputFormat == 'npz':
+                    table = self._readTable(self._filteredBlocks(data))
+                    self._writeTable(outFile, table)
+                    if self.tables is not None:
+                        self.tables[experiment] = table
                 else:
-                    outFile.write(line + '\n')
+                    for block in self._filteredBlocks(data):
+                        outFile.write(block)
+            os.replace(partName, fileName)
+        except requests.exceptions.RequestException:
+            # Also an OSError, but retried by _writeExperiment
+            raise
+        except OSError as e:
+            raise RnaSeqDumpError('Cannot write file {0}\n\n{1}'.format(fileName, e))
+        finally:
+            if os.path.exists(partName):
+                os.remove(partName)
+
+
+    def _fileName(self, experiment):
+        fileName = experiment.replace(' ', '_').replace('/', '-')
+        return '{0}/{1}.{2}'.format(self.outputDir, fileName, self.outputFormat)
+
+
+    def _loadManifest(self, fileName):
+        if fileName and os.path.exists(fileName):
+            try:
+                with open(fileName) as f:
+                    return json.load(f)
+            except ValueError as e:
+                logger.warning("Cannot read manifest {0}; all experiments will be retrieved again\n\n{1}".format(fileName, e))
+        return {}
+
+    def _fingerprint(self, jsonPayLoad):
+        # The request covers the organisms and the attributes of the experiment, and the format sets the file contents
+        return hashlib.sha256('{0}\t{1}'.format(self.outputFormat, jsonPayLoad).encode('utf-8')).hexdigest()
+
+    def _unchanged(self, experiment, jsonPayLoad):
+        entry = self.manifest.get(self._fileName(experiment))
+        if not self.manifestFile or not entry or entry['fingerprint'] != self._fingerprint(jsonPayLoad):
+            return False
+        try:
+            stat = os.stat(self._fileName(experiment))
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+    def _record(self, experiment, jsonPayLoad):
+        if not self.manifestFile:
+            return
+        fileName = self._fileName(experiment)
+        stat = os.stat(fileName)
+        with self.lock:
+            self.manifest[fileName] = {'experiment': experiment, 'fingerprint': self._fingerprint(jsonPayLoad), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            with open(self.manifestFile + '.tmp', 'w') as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            os.replace(self.manifestFile + '.tmp', self.manifestFile)
+
+
+    def _filteredBlocks(self, data):
+        carry = b''
+        for chunk in data.iter_content(chunk_size=self.chunkSize):
+            metrics.count('bytesReceived', len(chunk))
+            block = self._normaliseNewlines(carry + chunk)
+            end = block.rfind(b'\n') + 1
+            carry = block[end:]
+            block = self._filterRows(block[:end])
+            metrics.count('rows', block.count(b'\n'))
+            yield block
+        block = self._filterRows(carry + b'\n')
+        metrics.count('rows', block.count(b'\n'))
+        yield block
+
+
+    def _readTable(self, blocks):
+        """Reads a filtered tabular report into arrays.
+
+        Returns the sample names from the header, the gene IDs as a sorted dictionary and the index of each row's
+        gene in it, and the values as float32, with N/A as NaN.
+        """
+        np = _numpy()
+        header = None
+        genes = []
+        values = []
+        for block in blocks:
+            if header is None and block:
+                header, _, block = block.partition(b'\n')
+                header = header.decode('utf-8').split('\t')
+            if block:
+                fields = block[:-1].replace(b'\n', b'\t').split(b'\t')
+                if len(fields) % len(header):
+                    raise ValueError('Report rows do not all have {0} columns'.format(len(header)))
+                genes.extend(fields[0::len(header)])
+                del fields[0::len(header)]
+                blockValues = np.array(fields, dtype=bytes).reshape(-1, len(header) - 1)
+                blockValues[blockValues == b'N/A'] = b'nan'
+                values.append(blockValues.astype(np.float32))
+        samples = np.array(header[1:] if header else [], dtype=str)
+        genes, geneCodes = np.unique(np.char.decode(np.array(genes, dtype=bytes), 'utf-8'), return_inverse=True)
+        values = np.concatenate(values) if values else np.empty((0, len(samples)), dtype=np.float32)
+        return samples, genes, geneCodes.astype(np.int32), values
+
+
+    def _loadTable(self, fileName):
+        with _numpy().load(fileName) as table:
+            return table['samples'], table['genes'], table['geneCodes'], table['values']
+
+
+    def _writeTable(self, fileHandle, table):
+        samples, genes, geneCodes, values = table
+        _numpy().savez_compressed(fileHandle, samples=samples, genes=genes, geneCodes=geneCodes, values=values)
+
+
+    def _writeMatrix(self):
+        """Writes the genes by samples matrix of all the experiments retrieved from the project."""
+        np = _numpy()
+        fileName = '{0}/{1}_matrix.npz'.format(self.outputDir, self.Session.project)
+        experiments = sorted(self.tables)
+        tables = [self.tables[experiment] for experiment in experiments]
+        genes = np.unique(np.concatenate([table[1] for table in tables])) if tables else np.array([], dtype=str)
+        columns = [len(table[0]) for table in tables]
+        matrix = np.full((len(genes), sum(columns)), np.nan, dtype=np.float32)
+        start = 0
+        for (samples, tableGenes, geneCodes, values), width in zip(tables, columns):
+            matrix[np.searchsorted(genes, tableGenes)[geneCodes], start:start + width] = values
+            start += width
+        logger.info('Writing matrix of {0} genes and {1} samples to file {2}'.format(len(genes), matrix.shape[1], fileName))
+        try:
+            with open(fileName + '.part', 'wb') as outFile:
+                np.savez_compressed(outFile, genes=genes, samples=np.concatenate([table[0] for table in tables]) if tables else np.array([], dtype=str),
+                                    experiments=np.repeat(np.array(experiments, dtype=str), columns), values=matrix)
         except FileNotFoundError as e:
-            logger.error('Cannot open file {0} for writing\n\n{1}'.format(fileName, e))
-            raise SystemExit()
-        outFile.close()
-            
-        
+            raise RnaSeqDumpError('Cannot open file {0} for writing\n\n{1}'.format(fileName, e))
+        os.replace(fileName + '.part', fileName)
+
+
+
+class RequestScheduler(object):
+    """Schedules requests to a server from any number of threads.
+
+    Requests are started at no more than the current rate, using a token bucket, and with no more than the current
+    number in flight. Both limits grow while responses are fast and are cut back when responses slow down or the
+    server returns 429 or 5xx. Those responses are retried after the Retry-After time given by the server, or after
+    an exponential backoff with jitter.
+    """
+
+    minRate = 1.0
+    maxBackoff = 60
+
+    def __init__(self, maxConcurrency=4, maxRate=10.0, retries=5):
+        self.maxConcurrency = maxConcurrency
+        self.maxRate = maxRate
+        self.retries = retries
+        self.concurrency = float(maxConcurrency)
+        self.rate = max(self.minRate, maxRate / 4)
+        self.tokens = 1.0
+        self.lastRefill = time.monotonic()
+        self.active = 0
+        self.baseLatency = {}
+        self.lastCut = 0.0
+        self.condition = threading.Condition()
+
+    def request(self, method, url, **kwargs):
+        for attempt in range(self.retries + 1):
+            with metrics.stage('throttle'):
+                self._acquire()
+            start = time.monotonic()
+            metrics.count('requests')
+            res = None
+            latency = None
+            congested = False
+            try:
+                res = method(url, **kwargs)
+                latency = time.monotonic() - start
+                congested = res.status_code == 429 or res.status_code >= 500
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                congested = True
+                if attempt == self.retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning("Request to {0} failed; retrying in {1:.1f} seconds\n\n{2}".format(url, delay, e))
+            finally:
+                # Any other error is raised to the caller, but the request still gives up its place
+                self._release(latency, congested, url)
+            if res is not None:
+                metrics.record('request', latency)
+                if not congested or attempt == self.retries:
+                    return res
+                delay = self._retryAfter(res)
+                delay = self._backoff(attempt) if delay is None else delay
+                res.close()
+                logger.warning("Server returned {0} for {1}; retrying in {2:.1f} seconds".format(res.status_code, url, delay))
+            metrics.count('retries')
+            sleep(delay)
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.lastRefill) * self.rate)
+                self.lastRefill = now
+                if self.active < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.rate if self.tokens < 1 else None)
+
+    def _release(self, latency=None, congested=False, url=None):
+        with self.condition:
+            self.active -= 1
+            if congested:
+                # Responses to requests sent before the last cut do not cut the limits again
+                if time.monotonic() - self.lastCut > 1:
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self.rate = max(self.minRate, self.rate / 2)
+                    self.lastCut = time.monotonic()
+            elif latency is not None:
+                # Latency is compared with the fastest response seen from the same url, as reports take longer than metadata
+                self.baseLatency[url] = min(latency, self.baseLatency.get(url, latency))
+                if latency > 2 * self.baseLatency[url]:
+                    # The server is slowing down, so send fewer requests at once
+                    self.concurrency = max(1.0, self.concurrency - 1)
+                else:
+                    self.concurrency = min(self.maxConcurrency, self.concurrency + 1 / self.concurrency)
+                    self.rate = min(self.maxRate, self.rate * 1.5)
+            self.condition.notify_all()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.maxBackoff, 2 ** attempt))
+
+    def _retryAfter(self, res):
+        retryAfter = res.headers.get('Retry-After')
+        if retryAfter is None:
+            return None
+        try:
+            return min(self.maxBackoff, max(0.0, float(retryAfter)))
+        except ValueError:
+            pass
+        try:
+            return min(self.maxBackoff, max(0.0, parsedate_to_datetime(retryAfter).timestamp() - time.time()))
+        except (TypeError, ValueError):
+            return None
+
 
 
 class Session(object):
 
-    def __init__(self, project):
+    def __init__(self, project, poolSize=10, maxRate=10.0, retries=5):
+        self.project = project
+        self.poolSize = poolSize
+        self.scheduler = RequestScheduler(poolSize, maxRate, retries)
         self.webAppMapper = {'amoebadb': 'amoeba', 'cryptodb': 'cryptodb', 'fungidb': 'fungidb', 'giardiadb': 'giardiadb', \
                               'hostdb': 'hostdb', 'microsporidiadb': 'micro', 'piroplasmadb': 'piro', 'plasmodb': 'plasmo', \
                               'toxodb': 'toxo', 'tritrypdb': 'tritrypdb', 'trichdb': 'trichdb', 'vectorbase': 'vectorbase'}
@@ -142,10 +561,10 @@ class Session(object):
         logger.info("Attempting to connect to {0}".format(self.baseUrl))
         try:
             s = requests.session()
+            s.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=self.poolSize))
             s.get(self.baseUrl)
         except requests.exceptions.ConnectionError as e:
-            logger.error("Cannot connect to {0}. Please check the project name '{1}' is correct and try again.\n\n{2}".format(self.baserUrl, project, e))
-            raise SystemExit()
+            raise RnaSeqDumpError("Cannot connect to {0}. Please check the project name '{1}' is correct and try again.\n\n{2}".format(self.baseUrl, project, e))
         logger.info("Connection succeeded")
         return s
 
@@ -153,8 +572,14 @@ class Session(object):
         if project.lower() in self.webAppMapper:
             return self.webAppMapper[project.lower()]
         else:
-            logger.error("Cannot find webapp for {0}. Please check that {0} is a valid VEuPathDB project\n".format(project))
-            raise SystemExit()
+            raise RnaSeqDumpError("Cannot find webapp for {0}. Please check that {0} is a valid VEuPathDB project\n".format(project))
+
+
+    def get(self, url, **kwargs):
+        return self.scheduler.request(self.session.get, url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.scheduler.request(self.session.post, url, data=data, **kwargs)
 
 
     def getDataResponse(self, res, url, dataType='json'):
@@ -164,26 +589,70 @@ class Session(object):
             elif dataType == 'text':
                 d = res
             else:
-                logger.error("Data type {0} is not recognised as a download type".format(dataType))
-                raise SystemExit()
+                raise RnaSeqDumpError("Data type {0} is not recognised as a download type".format(dataType))
 
         else:
             try:
                 res.raise_for_status()
             except requests.exceptions.HTTPError as e:
-                logger.error("Cannot retrieve file from url: {0}. Please check the URL is correct. In case of an outage at VEuPathDB, please try again later.\n\n{1}".format(url, e))
-                raise SystemExit()
+                raise RnaSeqDumpError("Cannot retrieve file from url: {0}. Please check the URL is correct. In case of an outage at VEuPathDB, please try again later.\n\n{1}".format(url, e))
         logger.info("Data successfully retrieved")
         return d
 
                 
 
-if __name__ == '__main__':
+def get_args():
     parser = ArgumentParser()
     parser.add_argument('--project', required=True, help='VEuPathDB project from which you wish to download RNA sequence data, e.g., PlasmoDB. For downloads from multiple projects, use a comma separated list, e.g, CryptoDB,ToxoDB')
     parser.add_argument('--outputDir', required=True, help='Directory for output files')
+    parser.add_argument('--workers', type=int, default=4, help='Number of experiments to retrieve at the same time')
+    parser.add_argument('--retries', type=int, default=5, help='Number of times to retry a request that fails or that the server is too busy to answer')
+    parser.add_argument('--maxRate', type=float, default=10.0, help='Maximum number of requests per second. The rate is adjusted automatically up to this limit')
+    parser.add_argument('--format', default='txt', choices=['txt', 'npz'], help='Output format. npz (which requires numpy) writes NumPy archives of the sample names, gene IDs and float32 values of each experiment')
+    parser.add_argument('--matrix', action='store_true', help='Also write a genes by samples matrix of all the experiments in each project to PROJECT_matrix.npz. Requires --format npz')
+    parser.add_argument('--incremental', action='store_true', help='Only retrieve experiments that are new or whose attributes have changed since the last run with --incremental, using a manifest of output files ({0}) in the output directory'.format(MANIFEST))
+    parser.add_argument('--cacheTTL', type=float, default=24, help='With --incremental, number of hours for which the organism list and experiments of each project are cached ({0} in the output directory)'.format(METADATA_CACHE))
+    parser.add_argument('--allOrganisms', action='store_true', help='Request the data of each experiment for all the organisms in the project, instead of finding the organisms the experiment has data for')
+    instrumentation.addArguments(parser)
     args = parser.parse_args()
-    for project in args.project.split(','):
-        session = Session(project)
-        rnaSeqParams = RnaSeqParams(args, session)
-        RnaSeqDumper(session, rnaSeqParams, args.outputDir)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.matrix and args.format != 'npz':
+        parser.error('--matrix requires --format npz')
+    return args
+
+
+def dumpProject(project, outputDir, workers=4, retries=5, maxRate=10.0, outputFormat='txt', matrix=False, incremental=False, cacheTTL=24, allOrganisms=False):
+    """Writes the data of each RNA-seq experiment in a project to outputDir, returning the experiments that failed.
+
+    Raises RnaSeqDumpError if the project cannot be reached or its metadata retrieved.
+    """
+    if outputFormat == 'npz':
+        _numpy()
+    cacheFile = os.path.join(outputDir, METADATA_CACHE)
+    manifest = os.path.join(outputDir, MANIFEST) if incremental else None
+    session = Session(project, workers, maxRate, retries)
+    with metrics.stage('metadata'):
+        # Without --incremental the organism list and experiments are always retrieved again
+        rnaSeqParams = RnaSeqParams(None, session, cacheFile, cacheTTL if incremental else 0)
+    rnaSeqDumper = RnaSeqDumper(session, rnaSeqParams, outputDir, workers, outputFormat=outputFormat, matrix=matrix, manifest=manifest, allOrganisms=allOrganisms)
+    return rnaSeqDumper.failures
+
+
+def main(args):
+    failures = []
+    try:
+        for project in args.project.split(','):
+            failures.extend(dumpProject(project, args.outputDir, args.workers, args.retries, args.maxRate, args.format, args.matrix,
+                                        args.incremental, args.cacheTTL, args.allOrganisms))
+    except RnaSeqDumpError as e:
+        logger.error(e)
+        raise SystemExit(1)
+    if failures:
+        logger.error('Data could not be retrieved for {0} experiments:\n{1}'.format(len(failures), '\n'.join(failures)))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(message)s')
+    instrumentation.run(main, get_args())